@@ -0,0 +1,60 @@
+from array import array
+from bisect import bisect_left
+
+BUCKET_SECONDS: int = 1
+
+
+class ActivityIndex:
+    """Message counts per bucket of BUCKET_SECONDS, stored as prefix sums so that the number of
+    messages between any two times is two lookups"""
+
+    def __init__(self, prefix_sums: array, bucket_seconds: float = BUCKET_SECONDS):
+        self.prefix_sums: array = prefix_sums  # prefix_sums[i] is the number of messages before bucket i
+        self.bucket_seconds: float = bucket_seconds
+
+    @classmethod
+    def from_offsets(cls, offsets, duration: float = None, bucket_seconds: float = BUCKET_SECONDS):
+        """Build the index from sorted message offsets by bisecting each bucket boundary,
+        which is O(buckets * log(messages)) rather than a pass over every message"""
+        if duration is None:
+            duration = offsets[-1] if len(offsets) else 0
+        num_buckets: int = int(duration // bucket_seconds) + 1
+        prefix_sums: array = array('Q', (bisect_left(offsets, bucket * bucket_seconds)
+                                         for bucket in range(num_buckets + 1)))
+        prefix_sums[-1] = len(offsets)
+        return cls(prefix_sums, bucket_seconds)
+
+    @classmethod
+    def from_counts(cls, counts: dict, bucket_seconds: float = BUCKET_SECONDS):
+        """Build the index from {bucket: message count}"""
+        num_buckets: int = max(counts, default=0) + 1
+        prefix_sums: array = array('Q', [0]) * (num_buckets + 1)
+        total: int = 0
+        for bucket in range(num_buckets):
+            total += counts.get(bucket, 0)
+            prefix_sums[bucket + 1] = total
+        return cls(prefix_sums, bucket_seconds)
+
+    @property
+    def duration(self) -> float:
+        return (len(self.prefix_sums) - 1) * self.bucket_seconds
+
+    def count(self, start_second: float, end_second: float) -> int:
+        """Messages between start_second and end_second, to the resolution of a bucket"""
+        return self._prefix(end_second) - self._prefix(start_second)
+
+    def densities(self, num_bins: int, duration: float = None) -> list:
+        """Message counts in num_bins equal slices of the VOD, for drawing a heatmap"""
+        duration = duration or self.duration
+        bin_seconds: float = duration / num_bins if num_bins else 0
+        return [self.count(index * bin_seconds, (index + 1) * bin_seconds) for index in range(num_bins)]
+
+    def _prefix(self, second: float) -> int:
+        bucket: int = min(max(0, int(second // self.bucket_seconds)), len(self.prefix_sums) - 1)
+        return self.prefix_sums[bucket]
+
+
+def term_offsets(messages, term: str) -> array:
+    """Offsets of the messages whose text contains term, ignoring case"""
+    term = term.lower()
+    return array('d', (message.offset for message in messages if term in message.text.lower()))
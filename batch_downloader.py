@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import json
+import os
+from time import time, strftime
+
+from chat_downloader import AsyncChatDownloader, parse_url, find_chat_cache, format_seconds, get_chat_cache, \
+    get_emote_cache, get_headers, CACHE_FOLDER, DOWNLOAD_WORKERS
+from http_client import AsyncHttpClient, MAX_CONCURRENCY
+
+BATCH_WORKERS: int = 4
+REPORT_INTERVAL: float = 2
+
+
+class BatchDownloader:
+    """Download the chats of many VODs concurrently on one event loop,
+    with at most num_workers videos and max_concurrency requests in flight at once"""
+
+    def __init__(self, video_ids: list, num_workers: int = BATCH_WORKERS, segments: int = DOWNLOAD_WORKERS,
+                 overwrite_cache=False, verbose=True, max_concurrency: int = MAX_CONCURRENCY, skipped: list = ()):
+        self.video_ids: list = video_ids
+        self.skipped: list = list(skipped)  # Entries that aren't video IDs or URLs, reported in the summary
+        self.num_workers: int = max(1, num_workers)
+        self.segments: int = segments
+        self.overwrite_cache = overwrite_cache
+        self.verbose = verbose
+        self.max_concurrency: int = max_concurrency
+        self.results: list = []
+        self.active: dict = {}
+        self._video_slots: asyncio.Semaphore = None
+        self._start_time: float = 0.0
+
+    def run(self) -> dict:
+        """Download every video and return the summary"""
+        return asyncio.run(self.run_async())
+
+    async def run_async(self) -> dict:
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        self._start_time = time()
+        self._video_slots = asyncio.Semaphore(self.num_workers)
+        for entry in self.skipped:
+            self.results.append({'video_id': entry, 'status': 'skipped', 'error': 'not a video ID or URL',
+                                 'messages': 0, 'seconds': 0.0, 'messages_per_second': 0.0})
+            if self.verbose:
+                print(format_result(self.results[-1]))
+        reporter: asyncio.Task = asyncio.ensure_future(self._report())
+        try:
+            async with AsyncHttpClient(get_headers(), max_concurrency=self.max_concurrency) as client:
+                await asyncio.gather(*(self._download_and_record(client, video_id) for video_id in self.video_ids))
+        finally:
+            reporter.cancel()
+        return self.summary()
+
+    async def _download_and_record(self, client: AsyncHttpClient, video_id: str):
+        async with self._video_slots:
+            result: dict = await self.download(client, video_id)
+        self.results.append(result)
+        if self.verbose:
+            print(format_result(result))
+
+    async def download(self, client: AsyncHttpClient, video_id: str) -> dict:
+        """Download a single video, returning its result entry for the summary"""
+        result: dict = {'video_id': video_id, 'status': '', 'messages': 0, 'seconds': 0.0,
+                        'messages_per_second': 0.0}
+        if not self.overwrite_cache and find_chat_cache(video_id):
+            result.update({'status': 'cached'})
+            return result
+
+        start_time: float = time()
+        chat_downloader: AsyncChatDownloader = AsyncChatDownloader(client, video_id,
+                                                                   overwrite_cache=self.overwrite_cache,
+                                                                   num_workers=self.segments)
+        self.active[video_id] = chat_downloader
+        try:
+            await chat_downloader.get_info()
+            chat_filename: str = await chat_downloader.download_chat()
+            result.update({'status': 'downloaded' if chat_filename else 'killed', 'title': chat_downloader.title})
+        except Exception as e:
+            result.update({'status': 'failed', 'error': repr(e)})
+        finally:
+            del self.active[video_id]
+
+        elapsed_time: float = time() - start_time
+        result.update({
+            'messages': chat_downloader.num_messages,
+            'seconds': round(elapsed_time, 2),
+            'messages_per_second': round(chat_downloader.num_messages / elapsed_time, 1) if elapsed_time else 0.0
+        })
+        return result
+
+    def kill(self):
+        for chat_downloader in list(self.active.values()):
+            chat_downloader.kill()
+
+    def summary(self) -> dict:
+        elapsed_time: float = time() - self._start_time
+        total_messages: int = sum(result.get('messages') for result in self.results)
+        statuses: dict = {}
+        for result in self.results:
+            statuses[result.get('status')] = statuses.get(result.get('status'), 0) + 1
+        return {
+            'videos': len(self.results),
+            'statuses': statuses,
+            'messages': total_messages,
+            'seconds': round(elapsed_time, 2),
+            'messages_per_second': round(total_messages / elapsed_time, 1) if elapsed_time else 0.0,
+            'cache': {'chats': get_chat_cache().stats(), 'emotes': get_emote_cache().stats()},
+            'results': self.results
+        }
+
+    async def _report(self):
+        """Periodically print the throughput of each active download and of the whole batch"""
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            if not self.verbose:
+                continue
+            active: list = list(self.active.items())
+            now: float = time()
+            total_messages: int = sum(result.get('messages') for result in self.results)
+            for video_id, chat_downloader in active:
+                total_messages += chat_downloader.num_messages
+                elapsed_time: float = now - chat_downloader._start_time if chat_downloader._start_time else 0
+                rate: float = chat_downloader.num_messages / elapsed_time if elapsed_time else 0.0
+                print(f'  {video_id}: {chat_downloader.num_messages} messages, {rate:.0f} msg/s, '
+                      f'{chat_downloader.progress:.0%}, ETA {chat_downloader.eta_str or "?"}')
+            elapsed_time = now - self._start_time
+            print(f'{len(self.results) - len(self.skipped)}/{len(self.video_ids)} videos done. '
+                  f'{total_messages} messages, {total_messages / elapsed_time:.0f} msg/s overall.')
+
+
+def format_result(result: dict) -> str:
+    log: str = f'{result.get("video_id")}: {result.get("status")}'
+    if result.get('status') == 'downloaded':
+        log += (f', {result.get("messages")} messages in {format_seconds(result.get("seconds"))} '
+                f'({result.get("messages_per_second")} msg/s)')
+    elif result.get('status') in ('failed', 'skipped'):
+        log += f' ({result.get("error")})'
+    return log
+
+
+def read_video_ids(entries: list, filenames: list) -> tuple:
+    """Collect video IDs from URLs/IDs given directly and from files with one per line.
+    Blank lines and lines starting with # are ignored, and duplicates are dropped.
+    Returns the video IDs and the entries that aren't video IDs or URLs."""
+    for filename in filenames:
+        with open(filename, 'r') as id_file:
+            entries += [line.strip() for line in id_file if line.strip() and not line.strip().startswith('#')]
+    video_ids: list = []
+    skipped: list = []
+    for entry in entries:
+        try:
+            video_id: str = parse_url(entry)
+        except ValueError:
+            skipped.append(entry)
+            continue
+        if video_id not in video_ids:
+            video_ids.append(video_id)
+    return video_ids, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download the chats of many Twitch VODs.')
+    parser.add_argument('videos', nargs='*', help='video IDs or URLs')
+    parser.add_argument('-f', '--file', action='append', default=[], help='file with one video ID or URL per line')
+    parser.add_argument('-j', '--jobs', type=int, default=BATCH_WORKERS, help='videos to download at once')
+    parser.add_argument('-s', '--segments', type=int, default=DOWNLOAD_WORKERS,
+                        help='parallel segments per video')
+    parser.add_argument('-c', '--concurrency', type=int, default=MAX_CONCURRENCY,
+                        help='requests in flight at once across all videos')
+    parser.add_argument('--overwrite-cache', action='store_true', help='download videos that are already cached')
+    parser.add_argument('--summary', help='where to write the JSON summary')
+    args = parser.parse_args()
+
+    video_ids, skipped = read_video_ids(args.videos, args.file)
+    if not video_ids:
+        parser.error(f'no video IDs given{" (skipped: " + ", ".join(skipped) + ")" if skipped else ""}')
+
+    batch: BatchDownloader = BatchDownloader(video_ids, num_workers=args.jobs, segments=args.segments,
+                                             overwrite_cache=args.overwrite_cache, max_concurrency=args.concurrency,
+                                             skipped=skipped)
+    summary: dict = batch.run()
+
+    summary_filename: str = args.summary or os.path.join(CACHE_FOLDER, f'batch-{strftime("%Y%m%d-%H%M%S")}.json')
+    with open(summary_filename, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print(f'{summary.get("videos")} videos: {summary.get("statuses")}. '
+          f'{summary.get("messages")} messages in {format_seconds(summary.get("seconds"))} '
+          f'({summary.get("messages_per_second")} msg/s).')
+    print(f'Summary written to {summary_filename}.')
+
+
+if __name__ == '__main__':
+    main()
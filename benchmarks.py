@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import chat_downloader
+from chat_downloader import process_messages, process_fragments, color_cache, open_cache, write_messages, \
+    iter_chat_chunks, COMPRESSION_EXTENSIONS
+from columnar_chat import ColumnarChat, write_columnar
+from golden_fragments import compile_legacy_matcher, legacy_process_fragments
+from message import Message, Fragment, message_from_dict, emote_fragments
+from message_store import MessageStore, WindowedMessageStore
+
+WORDS: tuple = ('hello', 'LUL', 'what', 'is', 'this', 'pog', 'no', 'way', 'lmao', 'chat', 'GG', 'nice', 'wow',
+                'FeelsBadMan', 'KKona', 'D:', 'SourPls', 'haHAA', '@streamer', '@Mod_Bob', '\U0001F602', '❤',
+                '\U0001F525', '!!!', '?')
+NAMES: tuple = tuple(f'viewer{index}' for index in range(5000))
+COLORS: tuple = (None, '#FF0000', '#1E90FF', '#8A2BE2', '#00FF7F', '#DAA520')
+
+
+def synthetic_comments(num_messages: int, duration: int = 36000, seed: int = 0) -> list:
+    """Raw comments shaped like the v5 comments endpoint's, spread over `duration` seconds"""
+    rng: random.Random = random.Random(seed)
+    comments: list = []
+    for index in range(num_messages):
+        fragments: list = [{'text': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))}]
+        if rng.random() < 0.2:
+            fragments.append({'text': 'Kappa', 'emoticon': {'emoticon_id': '25', 'emoticon_set_id': ''}})
+        name: str = rng.choice(NAMES)
+        comments.append({
+            '_id': f'id-{index}',
+            'content_offset_seconds': round(index * duration / num_messages, 3),
+            'commenter': {'display_name': name},
+            'message': {'user_color': COLORS[hash(name) % len(COLORS)], 'fragments': fragments}
+        })
+    return comments
+
+
+def synthetic_messages(num_messages: int, duration: int = 36000, seed: int = 0) -> list:
+    messages: list = []
+    process_messages(synthetic_comments(num_messages, duration, seed), messages)
+    return messages
+
+
+def bench_processing(num_messages: int):
+    """Messages per second through process_messages, and through process_fragments against the pipeline it
+    replaced"""
+    comments: list = synthetic_comments(num_messages)
+    available_emoji: set = chat_downloader.get_emoji_index()
+    color_cache.clear()
+    start: float = perf_counter()
+    process_messages(comments, [])
+    elapsed_time: float = perf_counter() - start
+    print(f'process_messages: {num_messages} messages in {elapsed_time:.2f}s '
+          f'({num_messages / elapsed_time:,.0f} messages/s)')
+
+    fragment_lists: list = [comment.get('message').get('fragments') for comment in comments]
+    bttv_matcher = compile_legacy_matcher(chat_downloader.bttv_emotes)
+    start = perf_counter()
+    for fragments in fragment_lists:
+        legacy_process_fragments(fragments, bttv_matcher, available_emoji)
+    legacy_time: float = perf_counter() - start
+    start = perf_counter()
+    for fragments in fragment_lists:
+        process_fragments(fragments)
+    fused_time: float = perf_counter() - start
+    print(f'process_fragments: {num_messages / fused_time:,.0f} messages/s, '
+          f'legacy four-stage pipeline: {num_messages / legacy_time:,.0f} messages/s')
+
+
+def bench_windowed_store(num_messages: int, duration: int = 36000, tick: float = 1.0):
+    """Peak memory and time per get while playing a columnar chat through a WindowedMessageStore"""
+    with tempfile.TemporaryDirectory() as folder:
+        chat_filename: str = os.path.join(folder, 'chat.tcc')
+        write_columnar(synthetic_messages(num_messages, duration), chat_filename)
+        tracemalloc.start()
+        start: float = perf_counter()
+        with ColumnarChat(chat_filename) as chat:
+            message_store: WindowedMessageStore = WindowedMessageStore(chat)
+            second: float = 0.0
+            while second < duration:
+                message_store.get(second, second + tick)
+                second += tick
+            message_store.get(duration / 2, duration / 2, earlier_messages=50)  # Seek back
+            del message_store
+        elapsed_time: float = perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    print(f'windowed store: {num_messages} messages, {peak / 2 ** 20:.1f} MiB peak, '
+          f'{elapsed_time / (duration / tick) * 1e6:.0f}us per get')
+
+
+def bench_codecs(num_messages: int):
+    """Compression ratio, write time, time to the first chunk and full load time of the JSONL cache per codec"""
+    messages: list = synthetic_messages(num_messages)
+    with tempfile.TemporaryDirectory() as folder:
+        uncompressed_size: int = 0
+        for codec, suffix in [(None, '')] + [(codec, f'.{suffix}') for codec, suffix in COMPRESSION_EXTENSIONS.items()]:
+            chat_filename: str = os.path.join(folder, f'chat.jsonl{suffix}')
+            start: float = perf_counter()
+            with open_cache(chat_filename, 'wt') as chat_cache:
+                write_messages(messages, chat_cache)
+            write_time: float = perf_counter() - start
+            size: int = os.path.getsize(chat_filename)
+            uncompressed_size = uncompressed_size or size
+
+            start = perf_counter()
+            chunks = iter_chat_chunks(chat_filename)
+            next(chunks)
+            first_chunk_time: float = perf_counter() - start
+            for _ in chunks:
+                pass
+            load_time: float = perf_counter() - start
+            print(f'{codec or "none":>5}: {size / 2 ** 20:6.1f} MiB (ratio {uncompressed_size / size:4.1f}), '
+                  f'write {write_time:5.2f}s, first chunk {first_chunk_time * 1000:4.0f}ms, load {load_time:5.2f}s')
+
+
+def bench_memory(num_messages: int):
+    """Memory held by a loaded chat as Message records versus the JSON dicts they used to be"""
+    lines: list = [json.dumps(message.to_dict()) for message in synthetic_messages(num_messages)]
+    for name, decode in (('dicts', json.loads), ('records', lambda line: message_from_dict(json.loads(line)))):
+        emote_fragments.clear()
+        tracemalloc.start()
+        messages: list = [decode(line) for line in lines]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:>7}: {size / 2 ** 20:6.1f} MiB, {size / len(messages):.0f} bytes/message')
+        del messages
+
+
+def bench_seeking(num_messages: int, duration: int = 36000, num_seeks: int = 10000, seed: int = 0):
+    """Random seeks with 50 messages of backfill, like skip_to_time, followed by a tick, on a MessageStore"""
+    rng: random.Random = random.Random(seed)
+    fragments: tuple = (Fragment('hello'),)
+    messages: list = [Message(NAMES[index % len(NAMES)], f'id-{index}', COLORS[1], index * duration / num_messages,
+                              fragments) for index in range(num_messages)]
+    start: float = perf_counter()
+    message_store: MessageStore = MessageStore(messages)
+    index_time: float = perf_counter() - start
+
+    start = perf_counter()
+    for _ in range(num_seeks):
+        second: float = rng.uniform(0, duration)
+        message_store.get(second, second, earlier_messages=50)
+        message_store.get(second, second + 0.05)
+    elapsed_time: float = perf_counter() - start
+    print(f'seeking: {num_messages} messages indexed in {index_time * 1000:.0f}ms, '
+          f'{elapsed_time / num_seeks * 1e6:.1f}us per seek and tick')
+
+
+STARTUP_SCRIPT: str = """
+import os, sys, time
+sys.path.insert(0, {repository!r})
+import chat_downloader
+from message_store import MessageStore
+chat_downloader.CACHE_FOLDER = {folder!r}
+chat_downloader.API_KEY_FILENAME = os.path.join({folder!r}, 'missing_api_key.txt')
+chat_downloader_thread = chat_downloader.ChatDownloader('1')
+chat_downloader_thread.start()
+while not chat_downloader_thread.messages and chat_downloader_thread.is_alive():
+    time.sleep(0.001)
+message_store = MessageStore([])
+message_store.set_messages(chat_downloader_thread.messages, '1', chat_downloader_thread.loaded)
+print(message_store.get(0, 60)[0].offset, flush=True)
+os._exit(0)
+"""
+
+
+def bench_startup(num_messages: int, runs: int = 5):
+    """Time from launching a fresh interpreter to the first message of a cached VOD,
+    offline and without an API key"""
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, 'chat-1.jsonl'), 'w', encoding='utf-8') as chat_cache:
+            write_messages(synthetic_messages(num_messages), chat_cache)
+        with open(os.path.join(folder, 'info-1.json'), 'w') as info_cache:
+            json.dump({'id': '1', 'title': 'Synthetic VOD', 'duration': '10h0m0s', 'length': 36000}, info_cache)
+        script: str = STARTUP_SCRIPT.format(repository=os.path.dirname(os.path.abspath(__file__)), folder=folder)
+        times: list = []
+        for _ in range(runs):
+            start: float = perf_counter()
+            process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, text=True)
+            first_message: str = process.stdout.readline()
+            times.append(perf_counter() - start)
+            process.wait()
+            if not first_message:
+                raise RuntimeError('the startup script failed')
+    print(f'startup: first message of a cached {num_messages} message VOD after {statistics.median(times):.2f}s '
+          f'(median of {runs} launches)')
+
+
+BENCHMARKS: dict = {
+    'processing': bench_processing,
+    'windowed': bench_windowed_store,
+    'codecs': bench_codecs,
+    'memory': bench_memory,
+    'startup': bench_startup,
+    'seeking': bench_seeking,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the chat replay benchmarks on synthetic chats.')
+    parser.add_argument('benchmarks', nargs='*', help=f'any of {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('-n', '--messages', type=int, default=100000, help='messages in the synthetic chat')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](args.messages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import os
+from threading import Thread, Lock, Event
+from time import time
+
+EVICTION_INTERVAL: float = 60  # Seconds between eviction passes when nothing has been written
+
+
+class CacheManager:
+    """Keeps a cache folder under a byte budget by evicting its least recently used entries
+    on a background thread.
+
+    An entry is every file that key_function maps to the same key, like a video's chat and info caches,
+    and files it maps to None are left alone. Access times are kept in the files' atime, set whenever
+    the cache is hit, so the LRU order survives restarts. Pinned entries are never evicted."""
+
+    def __init__(self, folder: str, budget: int, key_function=os.path.basename, on_evict=None):
+        self.folder: str = folder
+        self.budget: int = budget
+        self.key_function = key_function
+        self.on_evict = on_evict
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.evicted_bytes: int = 0
+        self._pins: dict = {}
+        self._lock: Lock = Lock()
+        self._wake: Event = Event()
+        self._thread: Thread = None
+
+    def start(self):
+        """Start evicting in the background"""
+        if self._thread is None and self.budget is not None:
+            self._thread = Thread(target=self._run, name=f'CacheManager({self.folder})', daemon=True)
+            self._thread.start()
+
+    def hit(self, filename: str):
+        """Count a cache hit and mark the file as just used"""
+        with self._lock:
+            self.hits += 1
+        try:
+            os.utime(filename, (time(), os.stat(filename).st_mtime))
+        except OSError:
+            pass
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def added(self):
+        """Note that something was written to the cache, so it may be over budget"""
+        self._wake.set()
+
+    def pin(self, key: str):
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, key: str):
+        with self._lock:
+            if self._pins.get(key, 0) > 1:
+                self._pins[key] -= 1
+            else:
+                self._pins.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+                'pinned': len(self._pins)
+            }
+
+    def evict(self) -> int:
+        """Remove least recently used entries until the folder is within budget. Returns the bytes freed."""
+        if self.budget is None or not os.path.isdir(self.folder):
+            return 0
+        entries: dict = {}
+        total_size: int = 0
+        with os.scandir(self.folder) as scan:
+            for dir_entry in scan:
+                if not dir_entry.is_file():
+                    continue
+                key: str = self.key_function(dir_entry.name)
+                if key is None:
+                    continue
+                stat: os.stat_result = dir_entry.stat()
+                entry: dict = entries.setdefault(key, {'size': 0, 'accessed': 0.0, 'paths': []})
+                entry['size'] += stat.st_size
+                entry['accessed'] = max(entry.get('accessed'), stat.st_atime, stat.st_mtime)
+                entry['paths'].append(dir_entry.path)
+                total_size += stat.st_size
+
+        freed: int = 0
+        # The most recently used entry is always kept, even if it doesn't fit in the budget on its own
+        for key, entry in sorted(entries.items(), key=lambda item: item[1].get('accessed'))[:-1]:
+            if total_size - freed <= self.budget:
+                break
+            with self._lock:
+                if key in self._pins:
+                    continue
+            for path in entry.get('paths'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            freed += entry.get('size')
+            with self._lock:
+                self.evictions += 1
+                self.evicted_bytes += entry.get('size')
+            if self.on_evict:
+                self.on_evict(key)
+        return freed
+
+    def _run(self):
+        while True:
+            self._wake.wait(EVICTION_INTERVAL)
+            self._wake.clear()
+            try:
+                self.evict()
+            except OSError:
+                pass
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from threading import Lock
+from time import time, sleep
+
+MANIFEST_FILENAME: str = 'manifest.json'
+MANIFEST_VERSION: int = 1
+CHECKSUM_CHUNK_SIZE: int = 1 << 20
+LOCK_TIMEOUT: float = 30  # Seconds after which a lock file left by a crashed process is taken over
+
+
+class CacheManifest:
+    """An index of the cached chats in a cache folder: per video its title, duration, message count,
+    cache file, size, format and processing versions, and checksum.
+
+    Every update rereads the manifest under a lock file and atomically replaces it, so a library can be
+    listed without opening any chat file, and downloads in other threads or processes don't lose each
+    other's entries."""
+
+    def __init__(self, folder: str):
+        self.folder: str = folder
+        self.filename: str = os.path.join(folder, MANIFEST_FILENAME)
+        self._lock: Lock = Lock()
+        self._videos: dict = None
+        self._mtime: int = None
+
+    def get(self, video_id: str) -> dict:
+        return self._load().get(video_id)
+
+    def entries(self) -> dict:
+        """Every entry, by video ID"""
+        return dict(self._load())
+
+    def record(self, video_id: str, chat_filename: str, **fields) -> dict:
+        """Add or replace the entry for a video's cached chat, computing its size and checksum"""
+        entry: dict = {
+            'filename': os.path.basename(chat_filename),
+            'size': os.path.getsize(chat_filename),
+            'checksum': file_checksum(chat_filename),
+            'updated': time(),
+            **fields
+        }
+        with self._locked():
+            videos: dict = self._load(force=True)
+            videos[video_id] = {**videos.get(video_id, {}), **entry}
+            self._save(videos)
+        return videos[video_id]
+
+    def remove(self, video_id: str):
+        with self._locked():
+            videos: dict = self._load(force=True)
+            if videos.pop(video_id, None) is not None:
+                self._save(videos)
+
+    def chat_filename(self, video_id: str) -> str:
+        """The full path of a video's cached chat, or None if it isn't in the manifest"""
+        entry: dict = self.get(video_id)
+        return os.path.join(self.folder, entry.get('filename')) if entry else None
+
+    def verify(self, video_id: str) -> bool:
+        """Whether a video's cached chat still matches the size and checksum it was recorded with"""
+        entry: dict = self.get(video_id)
+        chat_filename: str = self.chat_filename(video_id)
+        if not entry or not os.path.exists(chat_filename):
+            return False
+        if os.path.getsize(chat_filename) != entry.get('size'):
+            return False
+        return file_checksum(chat_filename) == entry.get('checksum')
+
+    @contextmanager
+    def _locked(self):
+        """Hold the manifest against other threads and, through a lock file, other processes"""
+        lock_filename: str = self.filename + '.lock'
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            while True:
+                try:
+                    os.close(os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    break
+                except FileExistsError:
+                    try:
+                        if time() - os.path.getmtime(lock_filename) > LOCK_TIMEOUT:
+                            os.remove(lock_filename)
+                    except FileNotFoundError:
+                        pass
+                    sleep(0.01)
+            try:
+                yield
+            finally:
+                os.remove(lock_filename)
+
+    def _load(self, force=False) -> dict:
+        """The entries on disk, reread only if the manifest has changed since the last read"""
+        try:
+            mtime: int = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            self._videos, self._mtime = {}, None
+            return self._videos
+        if force or self._videos is None or mtime != self._mtime:
+            try:
+                with open(self.filename, 'r', encoding='utf-8') as manifest_file:
+                    self._videos = json.load(manifest_file).get('videos')
+            except ValueError:
+                self._videos = {}
+            self._mtime = mtime
+        return self._videos
+
+    def _save(self, videos: dict):
+        temp_filename: str = f'{self.filename}.{os.getpid()}.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'version': MANIFEST_VERSION, 'videos': videos}, manifest_file, indent=1)
+        os.replace(temp_filename, self.filename)
+        self._videos = videos
+        self._mtime = os.stat(self.filename).st_mtime_ns
+
+
+def file_checksum(filename: str) -> str:
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as chat_file:
+        while chunk := chat_file.read(CHECKSUM_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def main():
+    import argparse
+    from chat_downloader import CACHE_FOLDER, CHAT_EXTENSIONS, format_seconds, get_manifest, record_chat_cache, \
+        find_chat_cache
+
+    parser = argparse.ArgumentParser(description='List the cached chats.')
+    parser.add_argument('--verify', action='store_true', help='check every cached chat against its checksum')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='add cached chats missing from the manifest (reads each of them once)')
+    args = parser.parse_args()
+
+    manifest: CacheManifest = get_manifest()
+    if args.rebuild:
+        chat_extensions: tuple = tuple(f'.{extension}' for extension in CHAT_EXTENSIONS)
+        video_ids: set = {filename[len('chat-'):].split('.')[0] for filename in os.listdir(CACHE_FOLDER)
+                          if filename.startswith('chat-') and filename.endswith(chat_extensions)
+                          and '.part' not in filename}
+        for video_id in sorted(video_ids - set(manifest.entries())):
+            record_chat_cache(video_id, find_chat_cache(video_id))
+            print(f'Added {video_id}.')
+
+    for video_id, entry in sorted(manifest.entries().items(), key=lambda item: item[1].get('updated')):
+        line: str = (f'{video_id}: {entry.get("title")} ({format_seconds(entry.get("duration") or 0)}), '
+                     f'{entry.get("messages")} messages, {entry.get("size") / 2 ** 20:.1f} MiB {entry.get("format")}')
+        if args.verify:
+            line += ' OK' if manifest.verify(video_id) else ' CORRUPT'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import threading
+
+from message import Message, fragment_from_dict
+
+SCHEMA: str = '''
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT PRIMARY KEY,
+    title TEXT,
+    duration INTEGER,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    video_id TEXT NOT NULL,
+    content_offset REAL NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    color TEXT,
+    text TEXT,
+    fragments TEXT,
+    UNIQUE (video_id, id)
+);
+CREATE INDEX IF NOT EXISTS messages_video_offset ON messages (video_id, content_offset);
+'''
+
+FTS_SCHEMA: str = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, name, content='messages', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text, name) VALUES (new.rowid, new.text, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text, name) VALUES ('delete', old.rowid, old.text, old.name);
+END;
+'''
+
+MESSAGE_COLUMNS: str = 'messages.name, messages.id, messages.color, messages.content_offset, messages.fragments'
+
+
+class ChatDatabase:
+    """One SQLite database holding the chats of every downloaded VOD.
+
+    Messages are indexed by (video_id, offset) for range queries, and their text and usernames
+    by an FTS5 table when SQLite has it. The database runs in WAL mode so that several processes
+    can read it while one writes, and each thread gets its own connection."""
+
+    def __init__(self, filename: str):
+        self.filename: str = filename
+        self._local: threading.local = threading.local()
+        self.has_fts: bool = True
+        connection: sqlite3.Connection = self.connection
+        connection.executescript(SCHEMA)
+        try:
+            connection.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            self.has_fts = False
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection: sqlite3.Connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        connection: sqlite3.Connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def insert_messages(self, video_id: str, messages: list):
+        """Insert a page of processed messages, ignoring any that are already stored"""
+        with self.connection as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO messages (video_id, content_offset, id, name, color, text, fragments) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(video_id, message.offset, message.id, message.name, message.color,
+                  join_surrogates(message.text),
+                  json.dumps([fragment.to_dict() for fragment in message.fragments])) for message in messages])
+
+    def set_video(self, video_id: str, title: str = None, duration: int = None, complete=False):
+        with self.connection as connection:
+            connection.execute(
+                'INSERT INTO videos (video_id, title, duration, complete) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (video_id) DO UPDATE SET title = excluded.title, duration = excluded.duration, '
+                'complete = excluded.complete',
+                (video_id, title, duration, int(complete)))
+
+    def is_complete(self, video_id: str) -> bool:
+        row: tuple = self.connection.execute(
+            'SELECT complete FROM videos WHERE video_id = ?', (video_id,)).fetchone()
+        return bool(row and row[0])
+
+    def delete_video(self, video_id: str):
+        with self.connection as connection:
+            connection.execute('DELETE FROM messages WHERE video_id = ?', (video_id,))
+            connection.execute('DELETE FROM videos WHERE video_id = ?', (video_id,))
+
+    def count(self, video_id: str) -> int:
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM messages WHERE video_id = ?', (video_id,)).fetchone()[0]
+
+    def activity_counts(self, video_id: str, bucket_seconds: float = 1, term: str = None) -> dict:
+        """{bucket: number of messages} for buckets of bucket_seconds, counting only messages containing `term`,
+        ignoring case, if it's given"""
+        where: str = ' AND instr(lower(text), ?)' if term else ''
+        term_parameters: tuple = (term.lower(),) if term else ()
+        return dict(self.connection.execute(
+            f'SELECT CAST(content_offset / ? AS INTEGER) AS bucket, COUNT(*) FROM messages WHERE video_id = ?{where} '
+            f'GROUP BY bucket', (bucket_seconds, video_id, *term_parameters)))
+
+    def get_range(self, video_id: str, start_second: float, end_second: float) -> list:
+        """Messages with start_second <= offset < end_second, in order"""
+        return [row_to_message(row) for row in self.connection.execute(
+            f'SELECT {MESSAGE_COLUMNS} FROM messages WHERE video_id = ? AND content_offset >= ? '
+            f'AND content_offset < ? ORDER BY content_offset, rowid',
+            (video_id, start_second, end_second))]
+
+    def next_offset(self, video_id: str, second: float) -> float:
+        """The offset of the first message at or after `second`, or None if there isn't one"""
+        return self.connection.execute(
+            'SELECT MIN(content_offset) FROM messages WHERE video_id = ? AND content_offset >= ?',
+            (video_id, second)).fetchone()[0]
+
+    def get_before(self, video_id: str, second: float, limit: int) -> list:
+        """The last `limit` messages before `second`, in order"""
+        rows: list = self.connection.execute(
+            f'SELECT {MESSAGE_COLUMNS} FROM messages WHERE video_id = ? AND content_offset < ? '
+            f'ORDER BY content_offset DESC, rowid DESC LIMIT ?',
+            (video_id, second, limit)).fetchall()
+        return [row_to_message(row) for row in reversed(rows)]
+
+    def search(self, query: str, video_id: str = None, limit: int = 100) -> list:
+        """Search message text and usernames, with FTS5 query syntax when it's available.
+        Returns (video_id, message) pairs in order of offset."""
+        where: str = ' AND messages.video_id = ?' if video_id else ''
+        video_parameters: tuple = (video_id,) if video_id else ()
+        if self.has_fts:
+            rows: list = self.connection.execute(
+                f'SELECT messages.video_id, {MESSAGE_COLUMNS} FROM messages_fts '
+                f'JOIN messages ON messages.rowid = messages_fts.rowid '
+                f'WHERE messages_fts MATCH ?{where} ORDER BY messages.video_id, content_offset LIMIT ?',
+                (query, *video_parameters, limit)).fetchall()
+        else:
+            pattern: str = f'%{query}%'
+            rows = self.connection.execute(
+                f'SELECT messages.video_id, {MESSAGE_COLUMNS} FROM messages '
+                f'WHERE (text LIKE ? OR name LIKE ?){where} ORDER BY messages.video_id, content_offset LIMIT ?',
+                (pattern, pattern, *video_parameters, limit)).fetchall()
+        return [(row[0], row_to_message(row[1:])) for row in rows]
+
+
+def join_surrogates(text: str) -> str:
+    """Recombine the surrogate pairs that message processing splits characters outside the BMP into,
+    since SQLite only accepts valid UTF-8"""
+    if text.isascii():
+        return text
+    return text.encode('utf-16-le', 'surrogatepass').decode('utf-16-le', 'replace')
+
+
+def row_to_message(row: tuple) -> Message:
+    name, message_id, color, offset, fragments = row
+    return Message(name, message_id, color, offset, tuple(map(fragment_from_dict, json.loads(fragments))))
@@ -1,29 +1,73 @@
+import asyncio
+import bz2
+import gzip
+import hashlib
+import lzma
 from pprint import pprint
 import re
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Event
 
-import requests
-from time import sleep, time
+from time import time, monotonic
 import os
 import json
 
+import columnar_chat
+import highlights
+from cache_manager import CacheManager
+from cache_manifest import CacheManifest
+from chat_database import ChatDatabase
+from columnar_chat import ColumnarChat, write_columnar
+from http_client import HttpClient, AsyncHttpClient
+from message import Message, Fragment, emote_fragment, message_from_dict
+
 CURRENT_SCRIPT_DIR: str = os.path.dirname(os.path.realpath(__file__))
 CACHE_FOLDER: str = os.path.join(CURRENT_SCRIPT_DIR, 'downloaded_chats')
 EMOTES_FOLDER: str = os.path.join(CACHE_FOLDER, 'emote_cache')
+DATABASE_FILENAME: str = os.path.join(CACHE_FOLDER, 'chats.sqlite3')
+
+API_KEY_FILENAME: str = os.path.join(CURRENT_SCRIPT_DIR, 'api_key.txt')
+
+API_URL: str = os.environ.get('TWITCH_API_URL', 'https://api.twitch.tv')
+EMOTE_CDN_URL: str = os.environ.get('TWITCH_EMOTE_CDN_URL', 'https://static-cdn.jtvnw.net')
+INFO_URL: str = API_URL + '/helix/videos?id={video_id}'
+VIDEO_URL: str = API_URL + '/v5/videos/{video_id}'
+BASE_CHAT_URL: str = API_URL + '/v5/videos/{video_id}/comments?cursor={cursor}'
+OFFSET_CHAT_URL: str = API_URL + '/v5/videos/{video_id}/comments?content_offset_seconds={offset}'
 
-with open(os.path.join(CURRENT_SCRIPT_DIR, 'api_key.txt'), 'r') as key_file:
-    HEADERS: dict = {'Client-ID': key_file.read()}
-    
-BASE_CHAT_URL: str = 'https://api.twitch.tv/v5/videos/{video_id}/comments?cursor={cursor}'
-BASE_EMOTE_URL: str = 'https://static-cdn.jtvnw.net/emoticons/v1/{emote_id}/{emote_size}.0'
+BASE_EMOTE_URL: str = EMOTE_CDN_URL + '/emoticons/v1/{emote_id}/{emote_size}.0'
 EMOTE_SIZE = 1
-SLEEP_TIME: float = 1
+DOWNLOAD_WORKERS: int = 4
+MIN_SEGMENT_SECONDS: int = 300
+CHAT_EXTENSIONS: tuple = (columnar_chat.EXTENSION, 'jsonl', 'jsonl.gz', 'jsonl.bz2', 'jsonl.xz',
+                          'json')  # In order of preference
+INFO_EXTENSIONS: tuple = ('json', 'json.gz', 'json.bz2', 'json.xz')
+RAW_EXTENSIONS: tuple = ('jsonl', 'jsonl.gz', 'jsonl.bz2', 'jsonl.xz')
+CACHE_FORMAT: str = 'jsonl'  # Format of newly downloaded chats, 'jsonl' or columnar_chat.EXTENSION
+CACHE_COMPRESSION: str = None  # Codec for new JSON caches: None, 'gzip', 'bz2' or 'lzma'
+COMPRESSION_EXTENSIONS: dict = {'gzip': 'gz', 'bz2': 'bz2', 'lzma': 'xz'}
+CODECS: dict = {'gz': gzip, 'bz2': bz2, 'xz': lzma}
+CHUNK_MESSAGES: int = 5000
+JSONL_FORMAT_VERSION: int = 1
+PROCESSING_VERSION: int = 1  # Bump whenever process_messages changes what it produces
+# Bytes of chats kept in CACHE_FOLDER and of images kept in EMOTES_FOLDER, or None for no limit. Eviction deletes
+# downloaded chats, so it is off unless turned on in the environment, for machines that replay rather than archive
+CHAT_CACHE_BUDGET: int = int(os.environ.get('TWITCH_CHAT_CACHE_BUDGET', 0)) or None
+EMOTE_CACHE_BUDGET: int = int(os.environ.get('TWITCH_EMOTE_CACHE_BUDGET', 0)) or None
+PIPELINE_DEPTH: int = 4  # Pages fetched ahead of processing, per segment
+PROCESSING_WORKERS: int = 4
+GUI_TIMEOUT: tuple = (1, 3)  # (connect, read) seconds for requests made from the GUI thread, which block it
+EMOTE_RETRY_SECONDS: float = 300  # How long an emote that couldn't be fetched is shown as text before trying again
 
 UNICODE_MATCHER: re = re.compile('[\U00010000-\U0010FFFF]')
-EMOJI_RANGES = [(0x2139, 0x3299), (0x1F004, 0x1F9E6)]
+JSON_SEPARATOR_MATCHER: re = re.compile(r'[\s,]*')
+MENTION_MATCHER: re = re.compile(r'(?<!\S)@\S+')
 EMOJI_MATCHER: re = re.compile('[\U00002139-\U00003299\U0001F004-\U0001F9E6]')
+EMOJI_PREFIX: str = ('apple', 'windows')[1]
 
 color_cache = {}
+color_cache_lock: Lock = Lock()  # Pages are processed concurrently on processing_pool
+processing_pool: ThreadPoolExecutor = ThreadPoolExecutor(PROCESSING_WORKERS, thread_name_prefix='chat-processing')
 default_colors = (
     '#FF0000',  # Red
     '#0000FF',  # Blue
@@ -42,7 +86,7 @@ default_colors = (
     '#00FF7F'  # SpringGreen
 )
 
-bttv_emotes = (
+DEFAULT_BTTV_EMOTES: tuple = (
     'OhMyGoodness',
     'PancakeMix',
     'PedoBear',
@@ -147,9 +191,53 @@ bttv_emotes = (
 )
 
 
-class ChatDownloader(Thread):
-    def __init__(self, video_id: str, verbose=False, overwrite_cache=False):
-        super().__init__()
+def compile_fragment_matcher(emotes) -> re:
+    """Compile one alternation that finds every BTTV emote and emoji in a single pass over the text.
+    Longer emote names are tried first, so an emote is never split off from inside a longer one."""
+    emotes = sorted((emote for emote in emotes if emote), key=len, reverse=True)
+    pattern: str = f'(?P<emoji>{EMOJI_MATCHER.pattern})'
+    if emotes:
+        pattern = f'(?P<bttv>{"|".join(re.escape(emote) for emote in emotes)})|' + pattern
+    return re.compile(pattern)
+
+
+def set_bttv_emotes(emotes):
+    """Replace the set of BTTV emotes that get split out of message text"""
+    global bttv_emotes, FRAGMENT_MATCHER
+    emotes = list(dict.fromkeys(emotes))
+    FRAGMENT_MATCHER = compile_fragment_matcher(emotes)
+    bttv_emotes = emotes
+
+
+def add_bttv_emotes(emotes):
+    set_bttv_emotes(bttv_emotes + list(emotes))
+
+
+def load_bttv_emotes(filename: str, replace=False):
+    """Load BTTV emote names from a JSON list or a text file with one name per line"""
+    with open(filename, 'r', encoding='utf-8') as emote_file:
+        if filename.endswith('.json'):
+            emotes: list = json.load(emote_file)
+        else:
+            emotes = [line.strip() for line in emote_file if line.strip()]
+    if replace:
+        set_bttv_emotes(emotes)
+    else:
+        add_bttv_emotes(emotes)
+
+
+bttv_emotes: list = list(DEFAULT_BTTV_EMOTES)
+FRAGMENT_MATCHER: re = compile_fragment_matcher(bttv_emotes)
+
+
+class AsyncChatDownloader:
+    """Downloads the info and chat of one video on an asyncio event loop.
+    Any number of these can share one AsyncHttpClient, and so one connection pool and concurrency limit."""
+
+    def __init__(self, client: AsyncHttpClient, video_id: str, verbose=False, overwrite_cache=False,
+                 num_workers: int = DOWNLOAD_WORKERS, resume=True, fetch_emotes=True, database: ChatDatabase = None):
+        self.client: AsyncHttpClient = client
+        self.database: ChatDatabase = database
         self.info: dict = {}
         self.title: str = ''
         self.duration: int = 0
@@ -157,9 +245,18 @@ class ChatDownloader(Thread):
         self.duration_done_str: str = ''
         self.progress: float = 0.0
         self.num_messages: int = 0
-        self.messages: list = []
         self.eta_str: str = ''
         self.killed = False
+        self.num_workers: int = max(1, num_workers)
+        self.resume = resume
+        self.fetch_emotes = fetch_emotes
+        self._start_time: float = 0.0
+        self._segments: list = []
+        self._segment_done: list = []
+        self._segment_messages: list = []
+        self._initial_done: float = 0.0
+        self._emote_ids: set = set()
+        self._emote_tasks: list = []
 
         if video_id and video_id.startswith('v'):
             video_id = video_id[1:]
@@ -167,230 +264,798 @@ class ChatDownloader(Thread):
         self.verbose = verbose
         self.overwrite_cache = overwrite_cache
 
-    def run(self):
-        self.messages = self.download()
-
-    def download(self) -> list:
-        self.get_info()
+    async def download(self) -> list:
+        await self.get_info()
         self.duration = parse_duration(self.info.get('duration'))
         self.title = self.info.get('title')
         self.duration_str = format_seconds(self.duration)
-        return self.get_chat()
+        return await self.get_chat()
 
-    def get_info(self) -> dict:
+    async def get_info(self) -> dict:
         video_id = self.video_id
-        if video_id.startswith('v'):
-            video_id = video_id[1:]
-        info_filename: str = os.path.join(CACHE_FOLDER, f'info-{video_id}.json')
-        if not self.overwrite_cache and os.path.exists(info_filename):
-            with open(info_filename, 'r') as info_cache:
+        info_filename: str = find_info_cache(video_id)
+        if not self.overwrite_cache and info_filename:
+            with open_cache(info_filename, 'rt') as info_cache:
                 self.info = json.load(info_cache)
                 return self.info
 
-        url: str = f'https://api.twitch.tv/helix/videos?id={video_id}'
-        response: dict = requests.get(url, headers=HEADERS).json().get('data')[0]
+        url: str = INFO_URL.format(video_id=video_id)
+        response: dict = (await self.client.get_json(url)).get('data')[0]
         response.update({'length': parse_duration(response.get('duration'))})
         self.info = response
 
         # cache downloaded info
-        with open(info_filename, 'w') as info_cache:
+        info_filename = os.path.join(CACHE_FOLDER, f'info-{video_id}.{cache_extension("json")}')
+        with open_cache(info_filename, 'wt') as info_cache:
             print(f'Caching chat to {info_filename}.')
             json.dump(self.info, info_cache)
         return response
 
-    def get_chat(self) -> list:
+    async def get_chat(self) -> list:
+        chat_filename: str = await self.download_chat()
+        if not chat_filename:
+            return []
+        return await asyncio.to_thread(load_chat, chat_filename)
+
+    async def download_chat(self) -> str:
+        """Download the chat into the cache unless it is already there, and return the cache filename.
+        Pages are streamed to disk as they arrive, so memory use is bounded by a page."""
         video_id = self.video_id
-        if video_id.startswith('v'):
-            video_id = video_id[1:]
-        chat_filename: str = os.path.join(CACHE_FOLDER, f'chat-{video_id}.json')
-        if not self.overwrite_cache and os.path.exists(chat_filename):
+        cached_filename: str = find_chat_cache(video_id)
+        if not self.overwrite_cache and cached_filename:
             print('Reading cached copy of chat.')
-            with open(chat_filename, 'r') as chat_cache:
-                return json.load(chat_cache)
+            get_chat_cache().hit(cached_filename)
+            rederived: bool = False
+            if is_stale(video_id) and find_raw_cache(video_id):
+                if self.verbose:
+                    print('Reprocessing cached chat.')
+                cached_filename = await asyncio.to_thread(rederive_chat, video_id)
+                rederived = True
+            if self.database and (rederived or not self.database.is_complete(video_id)):
+                await asyncio.to_thread(import_chat, self.database, video_id, cached_filename)
+            return cached_filename
 
         if self.verbose:
             print('Downloading chat.')
+        get_chat_cache().miss()
+        get_chat_cache().pin(video_id)
+        try:
+            return await self._download_chat()
+        finally:
+            get_chat_cache().unpin(video_id)
+            get_chat_cache().added()
+
+    async def _download_chat(self) -> str:
+        video_id = self.video_id
 
         if not self.info:
-            self.info = self.get_info()
+            self.info = await self.get_info()
         self.duration = parse_duration(self.info.get('duration'))
         self.title = self.info.get('title')
         self.duration_str = format_seconds(self.duration)
         if self.verbose:
             print(self.info.get('title') + ': ' + self.info.get('duration'))
 
-        start_time: float = time()
-        messages: list = []
-        url: str = f'https://api.twitch.tv/v5/videos/{video_id}/comments?content_offset_seconds=0'
-        response: dict = requests.get(url, headers=HEADERS).json()
-        process_messages(response.get('comments'), messages)
-        cursor: str = response.get('_next')
-        url = BASE_CHAT_URL.format(video_id=video_id, cursor=cursor)
-        while '_next' in response and not self.killed:
-            response = requests.get(url, headers=HEADERS).json()
-            process_messages(response.get('comments'), messages)
-
-            elapsed_time = time() - start_time
-            duration_done = messages[-1].get('offset')
-            if duration_done > self.duration:
-                self.duration = duration_done
-            self.progress = duration_done / self.duration
-            eta = (elapsed_time / self.progress) - elapsed_time
-            self.eta_str = format_seconds(eta)
-            self.num_messages = len(messages)
-            self.duration_done_str = format_seconds(duration_done)
+        self._start_time = time()
+        segments: list = self._load_checkpoint()
+        if segments:
             if self.verbose:
-                log: str = f'{self.num_messages} messages. '
-                log += f'{self.duration_done_str}/{self.duration_str}. '
-                log += f'Time Left: {self.eta_str}.'
-                print('\r' + log, end='', flush=True)
-            cursor = response.get('_next')
-            url = BASE_CHAT_URL.format(video_id=video_id, cursor=cursor)
-            # sleep(SLEEP_TIME)
+                print('Resuming download from checkpoint.')
+        else:
+            starts: list = self._segment_starts()
+            ends: list = starts[1:] + [None]
+            segments = [{'start': start, 'end': end, 'cursor': None, 'done': 0.0, 'messages': 0, 'bytes': 0,
+                         'raw_bytes': 0, 'finished': False} for start, end in zip(starts, ends)]
+            if self.database:
+                await asyncio.to_thread(self.database.delete_video, video_id)
+        self._segments = segments
+        self._segment_done = [segment.get('done') for segment in segments]
+        self._segment_messages = [segment.get('messages') for segment in segments]
+        self._initial_done = sum(self._segment_done)
+        await asyncio.gather(*(self._download_segment(index) for index in range(len(segments))))
+        await asyncio.gather(*self._emote_tasks, return_exceptions=True)
 
         if self.killed:
             if self.verbose:
                 print('killed')
-            return []
+            return ''
 
-        if self.verbose and not self.killed:
+        if self.verbose:
             print('\nDone downloading.')
 
         # cache downloaded chat
-        if not self.killed:
-            with open(chat_filename, 'w') as chat_cache:
-                print(f'Caching chat to {chat_filename}.')
-                json.dump(messages, chat_cache)
-        return messages
+        chat_filename: str = os.path.join(CACHE_FOLDER, f'chat-{video_id}.{cache_extension("jsonl")}')
+        print(f'Caching chat to {chat_filename}.')
+        part_filenames: list = [self._part_filename(index) for index in range(len(segments))]
+        self.num_messages = await asyncio.to_thread(merge_part_files, part_filenames, chat_filename)
+        remove_chat_caches(video_id, keep=chat_filename)
+        # Checkpoints from before raw comments were cached don't have them for the whole video
+        if all('raw_bytes' in segment for segment in segments):
+            raw_filename: str = os.path.join(CACHE_FOLDER, f'raw-{video_id}.{cache_extension("jsonl")}')
+            raw_part_filenames: list = [self._part_filename(index, raw=True) for index in range(len(segments))]
+            await asyncio.to_thread(merge_part_files, raw_part_filenames, raw_filename, '_id')
+            remove_raw_caches(video_id, keep=raw_filename)
+        self._clear_checkpoint()
+        if self.database:
+            await asyncio.to_thread(self.database.set_video, video_id, self.title, self.duration, True)
+        if CACHE_FORMAT == columnar_chat.EXTENSION:
+            chat_filename = await asyncio.to_thread(convert_chat_cache, video_id)
+        else:
+            await asyncio.to_thread(record_chat_cache, video_id, chat_filename, self.title, self.duration,
+                                    self.num_messages)
+        return chat_filename
 
     def kill(self):
         self.killed = True
 
+    def _segment_starts(self) -> list:
+        """Split the VOD into evenly spaced segment start offsets, one per worker"""
+        num_segments: int = min(self.num_workers, max(1, self.duration // MIN_SEGMENT_SECONDS))
+        return [self.duration * index // num_segments for index in range(num_segments)]
+
+    async def _download_segment(self, index: int):
+        """Follow the comment cursors from the segment's start until the next segment's start is reached.
+        Fetching and processing run as two stages joined by a bounded queue, so the next page
+        is already in flight while the previous one is being processed."""
+        segment: dict = self._segments[index]
+        start: int = segment.get('start')
+        end: int = segment.get('end')
+        truncate_part_file(self._part_filename(index), segment.get('bytes'))
+        truncate_part_file(self._part_filename(index, raw=True), segment.get('raw_bytes', 0))
+        if segment.get('finished'):
+            return
+
+        if segment.get('cursor'):
+            url: str = BASE_CHAT_URL.format(video_id=self.video_id, cursor=segment.get('cursor'))
+        else:
+            url = OFFSET_CHAT_URL.format(video_id=self.video_id, offset=start)
+        pages: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+        await asyncio.gather(self._fetch_pages(url, end, pages), self._process_pages(index, pages))
+
+    async def _fetch_pages(self, url: str, end: int, pages: asyncio.Queue):
+        """Fetch raw comment pages into the queue, blocking while the processing stage is PIPELINE_DEPTH behind"""
+        try:
+            while url and not self.killed:
+                response: dict = await self.client.get_json(url)
+                comments: list = response.get('comments')
+                if comments is None:
+                    raise ValueError(f'No comments in the response from {url}')
+                reached_end: bool = False
+                if end is not None:
+                    in_segment: list = [comment for comment in comments
+                                        if comment.get('content_offset_seconds') < end]
+                    reached_end = len(in_segment) < len(comments)
+                    comments = in_segment
+                if self.fetch_emotes:
+                    self._queue_emotes(comments)
+
+                cursor: str = response.get('_next')
+                url = BASE_CHAT_URL.format(video_id=self.video_id, cursor=cursor) if cursor and not reached_end else None
+                await pages.put((comments, cursor, url is None))
+        finally:
+            await pages.put(None)
+
+    async def _process_pages(self, index: int, pages: asyncio.Queue):
+        """Process fetched pages in order on the processing pool, appending each to the segment's part file,
+        and the raw comments to its raw part file, and checkpointing the cursor after it"""
+        segment: dict = self._segments[index]
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        with open(self._part_filename(index), 'a', encoding='utf-8') as part_file, \
+                open(self._part_filename(index, raw=True), 'a', encoding='utf-8') as raw_file:
+            while True:
+                page: tuple = await pages.get()
+                if page is None:
+                    break
+                comments, cursor, finished = page
+                num_messages, last_offset = await loop.run_in_executor(
+                    processing_pool, process_page, comments, part_file, raw_file, self.database, self.video_id)
+                segment.update({
+                    'cursor': cursor,
+                    'messages': segment.get('messages') + num_messages,
+                    'bytes': part_file.tell(),
+                    'raw_bytes': raw_file.tell(),
+                    'finished': finished
+                })
+                if num_messages:
+                    segment.update({'done': last_offset - segment.get('start')})
+                self._save_checkpoint()
+                self._update_progress(index, segment.get('done'), segment.get('messages'))
+
+    def _queue_emotes(self, comments: list):
+        """Start fetching the Twitch emotes used in a page that haven't been seen yet, alongside the chat"""
+        for comment in comments:
+            for fragment in comment.get('message').get('fragments') or []:
+                emote_id: str = (fragment.get('emoticon') or {}).get('emoticon_id')
+                if emote_id and emote_id not in self._emote_ids:
+                    self._emote_ids.add(emote_id)
+                    self._emote_tasks.append(asyncio.ensure_future(async_get_emote(self.client, emote_id)))
+
+    def _checkpoint_filename(self) -> str:
+        return os.path.join(CACHE_FOLDER, f'chat-{self.video_id}.checkpoint.json')
+
+    def _part_filename(self, index: int, raw=False) -> str:
+        if raw:
+            return os.path.join(CACHE_FOLDER, f'raw-{self.video_id}.part{index}.jsonl')
+        return os.path.join(CACHE_FOLDER, f'chat-{self.video_id}.part{index}.jsonl')
+
+    def _load_checkpoint(self) -> list:
+        """Return the segments saved by an interrupted download of this video, if any"""
+        checkpoint_filename: str = self._checkpoint_filename()
+        if not self.resume or not os.path.exists(checkpoint_filename):
+            return []
+        try:
+            with open(checkpoint_filename, 'r') as checkpoint_file:
+                return json.load(checkpoint_file).get('segments')
+        except ValueError:
+            return []
+
+    def _save_checkpoint(self):
+        """Atomically replace the checkpoint with the current state of every segment"""
+        checkpoint_filename: str = self._checkpoint_filename()
+        temp_filename: str = checkpoint_filename + '.tmp'
+        with open(temp_filename, 'w') as checkpoint_file:
+            json.dump({'video_id': self.video_id, 'segments': self._segments}, checkpoint_file)
+        os.replace(temp_filename, checkpoint_filename)
+
+    def _clear_checkpoint(self):
+        for index in range(len(self._segments)):
+            for part_filename in (self._part_filename(index), self._part_filename(index, raw=True)):
+                if os.path.exists(part_filename):
+                    os.remove(part_filename)
+        if os.path.exists(self._checkpoint_filename()):
+            os.remove(self._checkpoint_filename())
+
+    def _update_progress(self, index: int, duration_done: float, num_messages: int):
+        """Aggregate progress, message count and ETA across all segments"""
+        self._segment_done[index] = duration_done
+        self._segment_messages[index] = num_messages
+        total_done: float = sum(self._segment_done)
+        if total_done > self.duration:
+            self.duration = total_done
+            self.duration_str = format_seconds(self.duration)
+        elapsed_time: float = time() - self._start_time
+        self.progress = total_done / self.duration if self.duration else 0.0
+        if total_done > self._initial_done:
+            eta: float = elapsed_time * (self.duration - total_done) / (total_done - self._initial_done)
+            self.eta_str = format_seconds(eta)
+        self.num_messages = sum(self._segment_messages)
+        self.duration_done_str = format_seconds(total_done)
+        if self.verbose:
+            log: str = f'{self.num_messages} messages. '
+            log += f'{self.duration_done_str}/{self.duration_str}. '
+            log += f'Time Left: {self.eta_str}.'
+            print('\r' + log, end='', flush=True)
+
+
+class ChatDownloader(Thread):
+    """Synchronous wrapper that runs an AsyncChatDownloader on an event loop of its own,
+    for callers like DownloadPopup that poll its progress from another thread"""
+
+    def __init__(self, video_id: str, verbose=False, overwrite_cache=False, num_workers: int = DOWNLOAD_WORKERS,
+                 resume=True, database: ChatDatabase = None, lazy=False):
+        super().__init__()
+        self.messages: list = []
+        self.loaded: Event = Event()
+        self.lazy = lazy
+        self.downloader: AsyncChatDownloader = AsyncChatDownloader(
+            None, video_id, verbose=verbose, overwrite_cache=overwrite_cache, num_workers=num_workers,
+            resume=resume, database=database)
+
+    def run(self):
+        if self.downloader.database:
+            # The chat is read back from the database, so don't load it into memory
+            self.get_info()
+            self.download_chat()
+        elif self.lazy:
+            # Open the chat memory-mapped, converting it to the columnar format if needed
+            self.get_info()
+            if self.download_chat():
+                self.messages = ColumnarChat(convert_chat_cache(self.video_id))
+        else:
+            # Fill self.messages a chunk at a time, so the chat can be played before it is fully loaded
+            self.get_info()
+            chat_filename: str = self.download_chat()
+            if chat_filename.endswith(f'.{columnar_chat.EXTENSION}'):
+                self.messages = load_chat(chat_filename)
+            elif chat_filename:
+                for chunk in iter_chat_chunks(chat_filename):
+                    self.messages.extend(chunk)
+        self.loaded.set()
+
+    def download(self) -> list:
+        return self._run(self.downloader.download)
+
+    def get_info(self) -> dict:
+        return self._run(self.downloader.get_info)
+
+    def get_chat(self) -> list:
+        return self._run(self.downloader.get_chat)
+
+    def download_chat(self) -> str:
+        return self._run(self.downloader.download_chat)
+
+    def kill(self):
+        self.downloader.kill()
+
+    def _run(self, coroutine_function):
+        async def run_with_client():
+            # Cached videos are opened without a client, so without the API key or the network
+            if not self.downloader.overwrite_cache and is_cached(self.video_id):
+                return await coroutine_function()
+            async with AsyncHttpClient(get_headers()) as client:
+                self.downloader.client = client
+                return await coroutine_function()
+
+        return asyncio.run(run_with_client())
+
+    video_id = property(lambda self: self.downloader.video_id)
+    info = property(lambda self: self.downloader.info)
+    title = property(lambda self: self.downloader.title)
+    duration = property(lambda self: self.downloader.duration)
+    duration_str = property(lambda self: self.downloader.duration_str)
+    duration_done_str = property(lambda self: self.downloader.duration_done_str)
+    progress = property(lambda self: self.downloader.progress)
+    num_messages = property(lambda self: self.downloader.num_messages)
+    eta_str = property(lambda self: self.downloader.eta_str)
+    killed = property(lambda self: self.downloader.killed)
+
+
+def merge_part_files(part_filenames: list, chat_filename: str, id_key: str = 'id') -> int:
+    """Stream the segment part files in order into one cache file, dropping comments seen in an earlier segment.
+    Returns the number of messages written."""
+    seen_ids: set = set()
+    num_messages: int = 0
+    temp_filename: str = chat_filename + '.tmp'
+    with open_cache(temp_filename, 'wt') as chat_cache:
+        for part_filename in part_filenames:
+            if not os.path.exists(part_filename):
+                continue
+            with open(part_filename, 'r', encoding='utf-8') as part_file:
+                for line in part_file:
+                    message_id: str = json.loads(line).get(id_key)
+                    if message_id not in seen_ids:
+                        seen_ids.add(message_id)
+                        chat_cache.write(line)
+                        num_messages += 1
+    os.replace(temp_filename, chat_filename)
+    return num_messages
+
+
+def truncate_part_file(part_filename: str, size: int):
+    """Discard anything written to a segment's part file after its last checkpoint"""
+    if os.path.exists(part_filename):
+        with open(part_filename, 'r+', encoding='utf-8') as part_file:
+            part_file.truncate(size)
+
+
+def write_messages(messages: list, chat_cache):
+    """Append messages to a line-delimited cache file, one JSON object per line"""
+    for message in messages:
+        chat_cache.write(json.dumps(message.to_dict()) + '\n')
+
+
+def open_cache(filename: str, mode: str = 'rt'):
+    """Open a cache file in text mode, compressing or decompressing it as a stream
+    if its extension (ignoring a trailing .tmp) names a codec"""
+    codec = CODECS.get(filename.removesuffix('.tmp').rsplit('.', 1)[-1])
+    if codec:
+        return codec.open(filename, mode, encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+
+def cache_extension(extension: str) -> str:
+    """The extension of a new cache file, with the configured codec's suffix"""
+    if CACHE_COMPRESSION:
+        return f'{extension}.{COMPRESSION_EXTENSIONS[CACHE_COMPRESSION]}'
+    return extension
+
+
+def iter_chat(chat_filename: str):
+    """Yield the messages of a cached chat one at a time.
+    Reads columnar (.tcc), line-delimited (.jsonl, optionally compressed) and legacy single-array (.json) caches.
+    Compressed caches are decompressed as they are read."""
+    if chat_filename.endswith(f'.{columnar_chat.EXTENSION}'):
+        with ColumnarChat(chat_filename) as chat:
+            yield from chat
+        return
+    with open_cache(chat_filename, 'rt') as chat_cache:
+        if '.jsonl' in chat_filename:
+            for line in chat_cache:
+                if line.strip():
+                    yield message_from_dict(json.loads(line))
+        else:
+            yield from map(message_from_dict, iter_json_array(chat_cache))
+
+
+def iter_json_array(json_file, block_size: int = 1 << 16):
+    """Yield the elements of a JSON array one at a time, reading the file a block at a time"""
+    decoder: json.JSONDecoder = json.JSONDecoder()
+    buffer: str = json_file.read(block_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('Expected a JSON array')
+    position: int = 1
+    while True:
+        position = JSON_SEPARATOR_MATCHER.match(buffer, position).end()
+        if buffer.startswith(']', position):
+            return
+        try:
+            value, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            block: str = json_file.read(block_size)
+            if not block:
+                raise
+            buffer = buffer[position:] + block
+            position = 0
+            continue
+        yield value
+
+
+def iter_chat_chunks(chat_filename: str, chunk_size: int = CHUNK_MESSAGES):
+    """Yield the messages of a cached chat in lists of up to chunk_size, so that the start
+    of the chat can be used before the rest has been read and decompressed"""
+    chunk: list = []
+    for message in iter_chat(chat_filename):
+        chunk.append(message)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_chat(chat_filename: str):
+    """Load a cached chat as a sequence of messages.
+    Columnar caches are memory-mapped and decode messages only as they are accessed."""
+    if chat_filename.endswith(f'.{columnar_chat.EXTENSION}'):
+        return ColumnarChat(chat_filename)
+    return list(iter_chat(chat_filename))
+
+
+def find_chat_cache(video_id: str) -> str:
+    """Return the filename of the cached chat for a video, or None if it hasn't been downloaded.
+    Looks the video up in the manifest, falling back to probing for caches written before it."""
+    chat_filename: str = get_manifest().chat_filename(video_id)
+    if chat_filename and os.path.exists(chat_filename):
+        return chat_filename
+    for extension in CHAT_EXTENSIONS:
+        chat_filename: str = os.path.join(CACHE_FOLDER, f'chat-{video_id}.{extension}')
+        if os.path.exists(chat_filename):
+            return chat_filename
+    return None
+
+
+def is_cached(video_id: str) -> bool:
+    """Whether a video's chat and info are both cached, so it can be opened without the network"""
+    if video_id.startswith('v'):
+        video_id = video_id[1:]
+    return bool(find_chat_cache(video_id) and find_info_cache(video_id))
+
+
+def find_info_cache(video_id: str) -> str:
+    """Return the filename of the cached info for a video, or None if it hasn't been downloaded"""
+    for extension in INFO_EXTENSIONS:
+        info_filename: str = os.path.join(CACHE_FOLDER, f'info-{video_id}.{extension}')
+        if os.path.exists(info_filename):
+            return info_filename
+    return None
+
+
+def remove_chat_caches(video_id: str, keep: str = None):
+    """Remove the cached chat of a video in every format except `keep`"""
+    for extension in CHAT_EXTENSIONS:
+        chat_filename: str = os.path.join(CACHE_FOLDER, f'chat-{video_id}.{extension}')
+        if chat_filename != keep and os.path.exists(chat_filename):
+            os.remove(chat_filename)
+    if keep is None:
+        remove_raw_caches(video_id)
+        highlights_filename: str = get_highlights_filename(video_id)
+        if os.path.exists(highlights_filename):
+            os.remove(highlights_filename)
+        get_manifest().remove(video_id)
+
+
+def find_raw_cache(video_id: str) -> str:
+    """Return the filename of the raw comments cached for a video, or None if there aren't any"""
+    for extension in RAW_EXTENSIONS:
+        raw_filename: str = os.path.join(CACHE_FOLDER, f'raw-{video_id}.{extension}')
+        if os.path.exists(raw_filename):
+            return raw_filename
+    return None
+
+
+def remove_raw_caches(video_id: str, keep: str = None):
+    for extension in RAW_EXTENSIONS:
+        raw_filename: str = os.path.join(CACHE_FOLDER, f'raw-{video_id}.{extension}')
+        if raw_filename != keep and os.path.exists(raw_filename):
+            os.remove(raw_filename)
+
+
+def get_highlights_filename(video_id: str) -> str:
+    return os.path.join(CACHE_FOLDER, f'highlights-{video_id}.json')
+
+
+def get_highlights(video_id: str, message_store, terms: tuple = ()) -> list:
+    """The ranked highlights of a video's chat, cached next to it. They are found again if the chat has changed
+    since, going by its checksum in the manifest, or if they were found with other terms or settings."""
+    entry: dict = get_manifest().get(video_id) or {}
+    key: dict = {'checksum': entry.get('checksum'), **highlights.parameters(terms)}
+    highlights_filename: str = get_highlights_filename(video_id)
+    if entry and os.path.exists(highlights_filename):
+        with open(highlights_filename, 'r', encoding='utf-8') as highlights_file:
+            cached: dict = json.load(highlights_file)
+        if cached.get('key') == key:
+            return cached.get('highlights')
+
+    found: list = highlights.find_highlights(message_store, terms)
+    if entry:
+        with open(highlights_filename + '.tmp', 'w', encoding='utf-8') as highlights_file:
+            json.dump({'key': key, 'highlights': found}, highlights_file)
+        os.replace(highlights_filename + '.tmp', highlights_filename)
+    return found
+
+
+manifest: CacheManifest = None
+
+
+def get_manifest() -> CacheManifest:
+    """The manifest of the cache folder"""
+    global manifest
+    if manifest is None or manifest.folder != CACHE_FOLDER:
+        manifest = CacheManifest(CACHE_FOLDER)
+    return manifest
+
+
+chat_cache: CacheManager = None
+emote_cache: CacheManager = None
+
+
+def get_chat_cache() -> CacheManager:
+    """The manager keeping CACHE_FOLDER within CHAT_CACHE_BUDGET, started on first use"""
+    global chat_cache
+    if chat_cache is None or chat_cache.folder != CACHE_FOLDER:
+        chat_cache = CacheManager(CACHE_FOLDER, CHAT_CACHE_BUDGET, key_function=chat_cache_key,
+                                  on_evict=lambda video_id: get_manifest().remove(video_id))
+        chat_cache.start()
+    return chat_cache
+
+
+def get_emote_cache() -> CacheManager:
+    """The manager keeping EMOTES_FOLDER within EMOTE_CACHE_BUDGET, started on first use"""
+    global emote_cache
+    if emote_cache is None or emote_cache.folder != EMOTES_FOLDER:
+        emote_cache = CacheManager(EMOTES_FOLDER, EMOTE_CACHE_BUDGET, on_evict=forget_emote)
+        emote_cache.start()
+    return emote_cache
+
+
+def chat_cache_key(filename: str) -> str:
+    """The video a file in CACHE_FOLDER belongs to, or None if it isn't a finished cache of a video"""
+    if not filename.startswith(('chat-', 'raw-', 'info-', 'highlights-')) or filename.endswith('.tmp') \
+            or '.part' in filename or '.checkpoint' in filename:
+        return None
+    return filename.split('-', 1)[1].split('.')[0]
+
+
+def forget_emote(emote_filename: str):
+    """Drop an evicted emoji from the emoji index"""
+    match = re.fullmatch(f'{EMOJI_PREFIX}-(.)-{EMOTE_SIZE}\\.png', emote_filename)
+    if match and emoji_index is not None:
+        emoji_index.discard(match[1])
+
+
+def record_chat_cache(video_id: str, chat_filename: str, title: str = None, duration: int = None,
+                      num_messages: int = None) -> dict:
+    """Record a video's cached chat in the manifest. Missing details are taken from the info cache,
+    and the messages are counted if num_messages isn't given."""
+    if title is None or duration is None:
+        info_filename: str = find_info_cache(video_id)
+        if info_filename:
+            with open_cache(info_filename, 'rt') as info_cache:
+                info: dict = json.load(info_cache)
+            title = info.get('title') if title is None else title
+            duration = parse_duration(info.get('duration')) if duration is None else duration
+    if num_messages is None:
+        num_messages = sum(1 for _ in iter_chat(chat_filename))
+    details: dict = {'title': title, 'duration': duration}
+    return get_manifest().record(
+        video_id, chat_filename, **{key: value for key, value in details.items() if value is not None},
+        messages=num_messages, format=os.path.basename(chat_filename).split('.', 1)[1],
+        format_version=cache_format_version(chat_filename), processing_version=processing_version())
+
+
+def processing_version() -> str:
+    """The key of what process_messages currently produces: PROCESSING_VERSION and the BTTV emote set"""
+    emotes_digest: str = hashlib.sha1('\n'.join(sorted(bttv_emotes)).encode('utf-8')).hexdigest()[:8]
+    return f'{PROCESSING_VERSION}-{emotes_digest}'
+
+
+def is_stale(video_id: str) -> bool:
+    """Whether a video's cached chat was processed differently than it would be now"""
+    entry: dict = get_manifest().get(video_id)
+    return entry is not None and entry.get('processing_version') != processing_version()
+
+
+def rederive_chat(video_id: str) -> str:
+    """Rebuild a video's processed chat cache from its raw comments, without touching the network.
+    Returns the new cache filename."""
+    raw_filename: str = find_raw_cache(video_id)
+    if raw_filename is None:
+        raise FileNotFoundError(f'No raw comments cached for video {video_id}')
+    chat_filename: str = os.path.join(CACHE_FOLDER, f'chat-{video_id}.{cache_extension("jsonl")}')
+    num_messages: int = 0
+    with open_cache(raw_filename, 'rt') as raw_cache, open_cache(chat_filename + '.tmp', 'wt') as chat_cache:
+        page: list = []
+        for line in raw_cache:
+            page.append(json.loads(line))
+            if len(page) >= CHUNK_MESSAGES:
+                num_messages += write_processed(page, chat_cache)
+                page = []
+        num_messages += write_processed(page, chat_cache)
+    os.replace(chat_filename + '.tmp', chat_filename)
+    remove_chat_caches(video_id, keep=chat_filename)
+    if CACHE_FORMAT == columnar_chat.EXTENSION:
+        return convert_chat_cache(video_id)
+    record_chat_cache(video_id, chat_filename, num_messages=num_messages)
+    return chat_filename
+
+
+def write_processed(comments: list, chat_cache) -> int:
+    messages: list = []
+    process_messages(comments, messages)
+    write_messages(messages, chat_cache)
+    return len(messages)
+
+
+def cache_format_version(chat_filename: str) -> int:
+    if chat_filename.endswith(f'.{columnar_chat.EXTENSION}'):
+        return columnar_chat.FORMAT_VERSION
+    return JSONL_FORMAT_VERSION
+
+
+def convert_chat_cache(video_id: str, keep_original=False) -> str:
+    """Convert a video's JSON chat cache to the columnar format and return the new filename"""
+    chat_filename: str = find_chat_cache(video_id)
+    if chat_filename is None:
+        raise FileNotFoundError(f'No cached chat for video {video_id}')
+    if chat_filename.endswith(f'.{columnar_chat.EXTENSION}'):
+        return chat_filename
+    columnar_filename: str = os.path.join(CACHE_FOLDER, f'chat-{video_id}.{columnar_chat.EXTENSION}')
+    num_messages: int = write_columnar(iter_chat(chat_filename), columnar_filename)
+    if not keep_original:
+        remove_chat_caches(video_id, keep=columnar_filename)
+    record_chat_cache(video_id, columnar_filename, num_messages=num_messages)
+    return columnar_filename
+
+
+def import_chat(database: ChatDatabase, video_id: str, chat_filename: str, batch_size: int = 5000):
+    """Copy a cached chat file into the database in batches, then mark the video complete"""
+    database.delete_video(video_id)
+    batch: list = []
+    for message in iter_chat(chat_filename):
+        batch.append(message)
+        if len(batch) >= batch_size:
+            database.insert_messages(video_id, batch)
+            batch = []
+    database.insert_messages(video_id, batch)
+    database.set_video(video_id, complete=True)
+
+
+def process_page(comments: list, part_file, raw_file=None, database: ChatDatabase = None,
+                 video_id: str = None) -> tuple:
+    """Process a page of raw comments and append it to a part file, the raw comments to raw_file,
+    and the messages to the database if there is one. Returns the number of messages and the offset of the last one."""
+    page: list = []
+    process_messages(comments, page)
+    write_messages(page, part_file)
+    part_file.flush()
+    if raw_file:
+        for comment in comments:
+            raw_file.write(json.dumps(comment) + '\n')
+        raw_file.flush()
+    if database:
+        database.insert_messages(video_id, page)
+    return len(page), page[-1].offset if page else 0.0
+
 
 def process_messages(raw_messages: list, messages: list):
     for raw_message in raw_messages:
-        message = {
-            'name': raw_message.get('commenter').get('display_name'),
-            'id': raw_message.get('_id'),
-            'color': raw_message.get('message').get('user_color'),
-            'offset': raw_message.get('content_offset_seconds')
-        }
-
-        name = message.get('name').lower()
-        if message.get('color'):
-            if name not in color_cache:
-                color_cache.update({name: message.get('color')})
+        name: str = raw_message.get('commenter').get('display_name')
+        color: str = raw_message.get('message').get('user_color')
+
+        lower_name = name.lower()
+        if color:
+            if lower_name not in color_cache:
+                with color_cache_lock:
+                    color_cache.setdefault(lower_name, color)
         else:
-            color = calculate_color(name)
-            message.update({'color': color})
+            color = calculate_color(lower_name)
 
         # Insert BTTV emotes
-        fragments: list = raw_message.get('message').get('fragments')
-        message.update({'fragments': process_fragments(fragments)})
-        messages.append(message)
+        fragments: tuple = process_fragments(raw_message.get('message').get('fragments'))
+        messages.append(Message(name, raw_message.get('_id'), color, raw_message.get('content_offset_seconds'),
+                                fragments))
 
 
 def calculate_color(name: str, cache=True) -> str:
-    color: str
-    if name not in color_cache:
+    color: str = color_cache.get(name)
+    if color is None:
         index: int = (ord(name[0]) + ord(name[-1])) % len(default_colors)
         color = default_colors[index]
         if cache:
-            color_cache.update({name: color})
-    else:
-        color = color_cache.get(name)
+            with color_cache_lock:
+                color = color_cache.setdefault(name, color)
     return color
 
 
-def process_fragments(fragments: list):
-    fragments = process_bttv_emotes(fragments)
-    fragments = process_emoji(fragments)
-    fragments = process_unicode(fragments)
-    fragments = process_usernames(fragments)
-    return fragments
-
-
-def process_bttv_emotes(old_fragments: list) -> list:
-    fragments: list = []
-    for fragment in old_fragments:
-        if 'emoticon' not in fragment:
-            text: str = fragment.get('text')
-            while len(text) > 0 and any(emote in text for emote in bttv_emotes):
-                emote_found: str = None
-                found_index: int = len(text)  # Earliest
-                for emote in bttv_emotes:
-                    index = text.find(emote)
-                    if -1 < index < found_index:
-                        emote_found = emote
-                        found_index = index
-                if found_index > 0:
-                    fragments.append({
-                        'text': text[:found_index]
-                    })
-                fragments.append({
-                    'text': emote_found,
-                    'emoticon': {
-                        'emoticon_id': emote_found
-                    }
-                })
-                text = text[found_index + len(emote_found):]
-            if len(text) > 0:
-                fragments.append({
-                    'text': text
-                })
-        else:
-            fragments.append(fragment)
-    return fragments
-
-
-def process_emoji(old_fragments: list) -> list:
-    EMOTE_PREFIX: str = ('apple', 'windows')[1]
-    fragments = []
-    for fragment in old_fragments:
-        if 'emoticon' not in fragment:
-            text = fragment.get('text')
-            changed: bool = True
-            while EMOJI_MATCHER.search(text) and changed:
-                changed = False
-                for char in text:
-                    if any(low <= ord(char) <= high for low, high in EMOJI_RANGES):
-                        emote_name = f'{EMOTE_PREFIX}-{char}'
-                        emote_filename = f'{emote_name}-{EMOTE_SIZE}.png'
-                        if os.path.exists(os.path.join(EMOTES_FOLDER, emote_filename)):
-                            changed = True
-                            index = text.find(char)
-                            if index > 0:
-                                fragments.append({
-                                    'text': text[:index]
-                                })
-                            fragments.append({
-                                'text': char,
-                                'emoticon': {
-                                    'emoticon_id': emote_name
-                                }
-                            })
-                            text = text[index + 1:]
-            if len(text) > 0:
-                fragments.append({
-                    'text': text
-                })
-        else:
-            fragments.append(fragment)
-    return fragments
-
-
-def process_unicode(old_fragments: list) -> list:
-    fragments = []
-    for fragment in old_fragments:
-        if 'emoticon' not in fragments:
-            new_fragment = fragment.copy()
-            new_fragment.update({
-                'text': UNICODE_MATCHER.sub(replace_unicode, fragment.get('text'))
-            })
-            fragments.append(new_fragment)
-        else:
-            fragments.append(fragment)
-    return fragments
+def process_fragments(fragments: list) -> tuple:
+    """Split Twitch fragments into BTTV emotes, emoji, text and @-mentions in a single pass over each fragment.
+    Every emote, including Twitch's own, becomes its shared emote fragment."""
+    processed: list = []
+    matcher: re = FRAGMENT_MATCHER
+    available_emoji: set = get_emoji_index()
+    for fragment in fragments:
+        if 'emoticon' in fragment:
+            processed.append(emote_fragment(fragment.get('text'), fragment.get('emoticon').get('emoticon_id')))
+            continue
+        text: str = fragment.get('text')
+        position: int = 0
+        for match in matcher.finditer(text):
+            emote: str = match.group()
+            if match.lastgroup == 'emoji':
+                if emote not in available_emoji:
+                    continue
+                emote_id: str = f'{EMOJI_PREFIX}-{emote}'
+            else:
+                emote_id = emote
+            if match.start() > position:
+                process_text(text[position:match.start()], processed)
+            processed.append(emote_fragment(emote, emote_id))
+            position = match.end()
+        if position < len(text):
+            process_text(text[position:], processed)
+    return tuple(processed)
+
+
+def process_text(text: str, fragments: list):
+    """Append a run of plain text, encoding characters outside the BMP as surrogate pairs
+    and splitting out @-mentions tagged with the mentioned user's color"""
+    if not text.isascii():
+        text = UNICODE_MATCHER.sub(replace_unicode, text)
+    if '@' not in text:
+        fragments.append(Fragment(text))
+        return
+    position: int = 0
+    for match in MENTION_MATCHER.finditer(text):
+        if match.start() > position:
+            fragments.append(Fragment(text[position:match.start()]))
+        mention: str = match.group()
+        fragments.append(Fragment(mention, tag=calculate_color(mention[1:].lower(), cache=False)))
+        position = match.end()
+    if position < len(text):
+        fragments.append(Fragment(text[position:]))
+
+
+emoji_index: set = None
+
+
+def get_emoji_index() -> set:
+    """The emoji characters that have an image in the emote cache, indexed once per run"""
+    if emoji_index is None:
+        refresh_emoji_index()
+    return emoji_index
+
+
+def refresh_emoji_index():
+    """Rebuild the emoji index from the files in the emote cache"""
+    global emoji_index
+    prefix: str = f'{EMOJI_PREFIX}-'
+    suffix: str = f'-{EMOTE_SIZE}.png'
+    filenames: list = os.listdir(EMOTES_FOLDER) if os.path.isdir(EMOTES_FOLDER) else []
+    emoji_index = {
+        filename[len(prefix):-len(suffix)] for filename in filenames
+        if filename.startswith(prefix) and filename.endswith(suffix)
+        and EMOJI_MATCHER.fullmatch(filename[len(prefix):-len(suffix)])
+    }
 
 
 def replace_unicode(match):
@@ -401,40 +1066,60 @@ def replace_unicode(match):
             chr(int.from_bytes(encoded[2:], 'little')))
 
 
-def process_usernames(old_fragments: list) -> list:
-    fragments: list = []
-    for fragment in old_fragments:
-        if 'emoticon' not in fragment and '@' in fragment.get('text'):
-            tokens: list = re.findall(r'\S+|\s+', fragment.get('text'))
-            prev_index: int = 0
-            for index, token in enumerate(tokens):
-                if token.startswith('@') and len(token) > 1:
-                    text: str = ''.join(tokens[prev_index:index])
-                    if text:
-                        fragments.append({'text': text})
-                        
-                    name: str = token[1:].lower()
-                    fragments.append({'text': token, 'tag': calculate_color(name, cache=False)})
-                    prev_index = index + 1
-            text = ''.join(tokens[prev_index:])
-            if text:
-                fragments.append({'text': text})
-        else:
-            fragments.append(fragment)
-    return fragments
+failed_emotes: dict = {}  # {emote_id: when fetching it last failed}
 
 
 def get_emote(emote_id: str, read_cache=True) -> str:
-    emote_id = emote_id.replace(':', 'colon')
-    emote_filename: str = os.path.join(EMOTES_FOLDER, f'{emote_id}-{EMOTE_SIZE}.png')
-    if emote_id in ('SourPls', '(chompy)'):
-        emote_filename = emote_filename.replace('.png', '.gif')
+    """Return the filename of an emote's image, fetching it if it isn't cached. Fetches are tried once with a short
+    timeout, and an emote that failed isn't tried again for EMOTE_RETRY_SECONDS, so an unreachable CDN can't
+    stall the GUI."""
+    emote_filename: str = get_emote_filename(emote_id)
     if read_cache and os.path.exists(emote_filename):
+        get_emote_cache().hit(emote_filename)
         return emote_filename
-    url: str = BASE_EMOTE_URL.format(emote_id=emote_id, emote_size=EMOTE_SIZE)
-    image = requests.get(url, headers=HEADERS).content
+    get_emote_cache().miss()
+    if monotonic() - failed_emotes.get(emote_id, -EMOTE_RETRY_SECONDS) < EMOTE_RETRY_SECONDS:
+        raise ConnectionError(f'Fetching emote {emote_id} failed recently')
+    url: str = BASE_EMOTE_URL.format(emote_id=emote_id.replace(':', 'colon'), emote_size=EMOTE_SIZE)
+    try:
+        response = get_emote_http().get(url)
+        response.raise_for_status()
+    except OSError:
+        failed_emotes[emote_id] = monotonic()
+        raise
+    failed_emotes.pop(emote_id, None)
+    save_emote(emote_filename, response.content)
+    return emote_filename
+
+
+async def async_get_emote(client: AsyncHttpClient, emote_id: str, read_cache=True) -> str:
+    emote_filename: str = get_emote_filename(emote_id)
+    if read_cache and os.path.exists(emote_filename):
+        get_emote_cache().hit(emote_filename)
+        return emote_filename
+    get_emote_cache().miss()
+    url: str = BASE_EMOTE_URL.format(emote_id=emote_id.replace(':', 'colon'), emote_size=EMOTE_SIZE)
+    image: bytes = await client.get_bytes(url)
+    save_emote(emote_filename, image)
+    return emote_filename
+
+
+def save_emote(emote_filename: str, image: bytes):
+    """Write an emote image to the emote cache, keeping the emoji index in step with it"""
     with open(emote_filename, 'wb') as emote_file:
         emote_file.write(image)
+    if emoji_index is not None:
+        match = re.fullmatch(f'{EMOJI_PREFIX}-(.)-{EMOTE_SIZE}\\.png', os.path.basename(emote_filename))
+        if match and EMOJI_MATCHER.fullmatch(match[1]):
+            emoji_index.add(match[1])
+    get_emote_cache().added()
+
+
+def get_emote_filename(emote_id: str) -> str:
+    emote_id = emote_id.replace(':', 'colon')
+    emote_filename: str = os.path.join(EMOTES_FOLDER, f'{emote_id}-{EMOTE_SIZE}.png')
+    if emote_id in ('SourPls', '(chompy)'):
+        emote_filename = emote_filename.replace('.png', '.gif')
     return emote_filename
 
 
@@ -464,17 +1149,60 @@ def parse_duration(duration: str) -> int:
     return duration_seconds
 
 
+headers: dict = None
+http: HttpClient = None
+emote_http: HttpClient = None
+gui_http: HttpClient = None
+
+
+def get_headers() -> dict:
+    """The API headers, with the client ID read from api_key.txt the first time they are needed"""
+    global headers
+    if headers is None:
+        with open(API_KEY_FILENAME, 'r') as key_file:
+            headers = {'Client-ID': key_file.read()}
+    return headers
+
+
+def get_http() -> HttpClient:
+    global http
+    if http is None:
+        http = HttpClient(get_headers())
+    return http
+
+
+def get_emote_http() -> HttpClient:
+    """The client for emote images, which the CDN serves without a client ID, so cached VODs play without one.
+    It doesn't retry, since it is used from the GUI thread."""
+    global emote_http
+    if emote_http is None:
+        emote_http = HttpClient(timeout=GUI_TIMEOUT, max_retries=0)
+    return emote_http
+
+
+def get_gui_http() -> HttpClient:
+    """The API client for requests made from the GUI thread, tried once with a short timeout like emotes"""
+    global gui_http
+    if gui_http is None:
+        gui_http = HttpClient(get_headers(), timeout=GUI_TIMEOUT, max_retries=0)
+    return gui_http
+
+
 def parse_url(url: str) -> str:
+    """The video ID in a VOD URL or ID. Raises ValueError if there isn't one."""
     if 'player.twitch.tv' in url:
-        match = re.search('video=v?([0-9]{5,})', url)[1]
+        match = re.search('video=v?([0-9]{5,})', url)
     else:
-        match = re.search('v?([0-9]{5,})', url)[1]
-    return match
+        match = re.search('v?([0-9]{5,})', url)
+    if match is None:
+        raise ValueError(f'Not a video ID or URL: {url}')
+    return match[1]
 
 
 def video_exists(video_id):
-    url = f'https://api.twitch.tv/v5/videos/{video_id}'
-    status_code = requests.head(url, headers=HEADERS).status_code
+    """Whether Twitch has the video. Asked once with a short timeout, since the GUI waits for the answer."""
+    url = VIDEO_URL.format(video_id=video_id)
+    status_code = get_gui_http().head(url).status_code
     return status_code == 200
 
 
@@ -488,7 +1216,7 @@ def main():
         if 'http' in video_id or 'twitch.tv' in video_id:
             video_id = parse_url(video_id)
 
-    ChatDownloader(video_id, verbose=True, overwrite_cache=True).get_chat()
+    ChatDownloader(video_id, verbose=True, overwrite_cache=True).download_chat()
 
 
 if __name__ == '__main__':
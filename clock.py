@@ -1,55 +1,164 @@
-from threading import Thread, Event, Lock
-from time import time, sleep
+import random
+import sys
+from threading import Lock
+from time import monotonic, sleep
 
-TIME_STEP = 0.05
+SIMULATED_HOURS: float = 10
+MAX_DRIFT: float = 1e-6  # Seconds the simulated clock may be off after SIMULATED_HOURS
+MAX_JITTER: float = 1e-9  # Seconds a single tick may be off by
 
 
-class Clock(Thread):
-    def __init__(self):
-        Thread.__init__(self)
-        self.elapsed_time: float = 0
-        self.speed: float = 1
-        self.running: Event = Event()
-        self.running.set()
+class Clock:
+    """A playback clock computed on demand, without a thread: the elapsed time is the time it had when it was last
+    anchored plus the monotonic time since then, times the speed. It is re-anchored whenever it is paused, resumed,
+    set or changes speed, so it doesn't accumulate rounding errors or jump when the wall clock is changed."""
+
+    def __init__(self, time_function=monotonic):
+        self.time_function = time_function
+        self.running: bool = False
+        self._started: bool = False
         self._stopped: bool = False
-        self._dead: Event = Event()
-        self.elapsed_time_lock = Lock()
-
-    def run(self):
-        prev_time: float = time()
-        while not self._stopped:
-            if not self.running.is_set():
-                self.running.wait()
-                prev_time = time()
-
-            sleep(TIME_STEP)
-            with self.elapsed_time_lock:
-                current_time: float = time()
-                self.elapsed_time += (current_time - prev_time) * self.speed
-            prev_time = current_time
-        self._dead.set()
+        self._speed: float = 1
+        self._base: float = 0  # Elapsed time at the anchor
+        self._anchor: float = time_function()
+        self._lock: Lock = Lock()
+
+    @property
+    def elapsed_time(self) -> float:
+        with self._lock:
+            if not self.running:
+                return self._base
+            return self._base + (self.time_function() - self._anchor) * self._speed
+
+    @elapsed_time.setter
+    def elapsed_time(self, elapsed_time: float):
+        self.set_elapsed_time(elapsed_time)
+
+    @property
+    def speed(self) -> float:
+        return self._speed
+
+    @speed.setter
+    def speed(self, speed: float):
+        with self._lock:
+            self._reanchor()
+            self._speed = speed
+
+    def start(self):
+        """Start the clock"""
+        self._started = True
+        self.resume()
+
+    def is_alive(self) -> bool:
+        """Whether the clock has been started and not stopped"""
+        return self._started and not self._stopped
 
     def pause(self):
         """Pause the clock"""
-        self.running.clear()
+        with self._lock:
+            self._reanchor()
+            self.running = False
 
     def resume(self):
         """Resume the clock"""
-        self.running.set()
+        with self._lock:
+            if self._stopped:
+                return
+            self._reanchor()
+            self.running = True
 
     def stop(self):
-        """Stop the clock"""
-        self.running.set()
+        """Stop the clock for good"""
+        self.pause()
         self._stopped = True
-        self._dead.wait()
 
     def set_elapsed_time(self, elapsed_time: float):
         """Set the elapsed time of the clock"""
-        with self.elapsed_time_lock:
-            self.elapsed_time = elapsed_time
+        with self._lock:
+            self._anchor = self.time_function()
+            self._base = elapsed_time
+
+    def _reanchor(self):
+        now: float = self.time_function()
+        if self.running:
+            self._base += (now - self._anchor) * self._speed
+        self._anchor = now
+
+
+class SimulatedTime:
+    """A monotonic time source for testing the clock, advanced by hand"""
+
+    def __init__(self):
+        self.now: float = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def simulate(hours: float = 10, seed: int = 0, write_back_delay: float = None) -> tuple:
+    """Play a clock over simulated hours of irregular ticks, pauses, seeks and speed changes, tracking the
+    elapsed time it should have by summing exact intervals.
+
+    Returns (drift, jitter): the largest difference from the expected elapsed time, and the largest difference
+    between how far the clock moved in one tick and how far it should have. With write_back_delay, every tick
+    also sets the elapsed time it read that long after reading it, as the GUI once did."""
+    rng: random.Random = random.Random(seed)
+    simulated_time: SimulatedTime = SimulatedTime()
+    clock: Clock = Clock(simulated_time)
+    clock.start()
+    expected: float = 0.0
+    previous_reading: float = 0.0
+    drift: float = 0.0
+    jitter: float = 0.0
+    while simulated_time.now < 1000 + hours * 3600:
+        # Ticks as irregular as a busy event loop's, from a millisecond to a quarter of a second apart
+        step: float = rng.uniform(0.001, 0.25)
+        simulated_time.now += step
+        advance: float = step * clock.speed if clock.running else 0.0
+        expected += advance
+        reading: float = clock.elapsed_time
+        drift = max(drift, abs(reading - expected))
+        jitter = max(jitter, abs(reading - previous_reading - advance))
+        previous_reading = reading
+        if write_back_delay is not None:
+            simulated_time.now += write_back_delay
+            expected += write_back_delay * clock.speed if clock.running else 0.0
+            clock.set_elapsed_time(reading)
+            previous_reading = clock.elapsed_time
+
+        event: float = rng.random()
+        if event < 0.001:
+            clock.pause() if clock.running else clock.resume()
+        elif event < 0.002:
+            clock.speed = rng.choice((0.5, 1, 1.5, 2, 10))
+        elif event < 0.0025:
+            expected = previous_reading = rng.uniform(0, hours * 3600)
+            clock.set_elapsed_time(expected)
+    return drift, jitter
 
 
 def main():
+    failures: list = []
+    for seed in range(5):
+        drift, jitter = simulate(SIMULATED_HOURS, seed)
+        print(f'Simulated {SIMULATED_HOURS} hours (seed {seed}): drift {drift:.3g}s, jitter {jitter:.3g}s')
+        if drift > MAX_DRIFT or jitter > MAX_JITTER:
+            failures.append(f'seed {seed}: drift {drift:.3g}s, jitter {jitter:.3g}s')
+
+    # The check has to catch a caller that re-anchors the clock with a stale reading on every tick
+    drift, _ = simulate(SIMULATED_HOURS, write_back_delay=1e-6)
+    print(f'Writing back each reading 1us late: drift {drift:.3g}s')
+    if drift <= MAX_DRIFT:
+        failures.append(f'writing back readings went undetected, drift {drift:.3g}s')
+
+    paused_clock: Clock = Clock(SimulatedTime())
+    paused_clock.start()
+    paused_clock.pause()
+    paused_clock.time_function.now += 3600
+    print(paused_clock.elapsed_time, 'Should be 0 after an hour paused')
+    if paused_clock.elapsed_time != 0:
+        failures.append(f'paused clock moved to {paused_clock.elapsed_time}s')
+
     timer = Clock()
     timer.start()
     print(timer.elapsed_time, 'Should be ~0')
@@ -58,6 +167,9 @@ def main():
     print(timer.elapsed_time, 'Should be ~2')
     timer.stop()
 
+    if failures:
+        sys.exit('FAILED\n' + '\n'.join(failures))
+
 
 if __name__ == '__main__':
     main()
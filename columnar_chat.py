@@ -0,0 +1,165 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from message import Message, fragment_from_dict
+
+MAGIC: bytes = b'TWCC'
+FORMAT_VERSION: int = 1
+EXTENSION: str = 'tcc'
+
+# Header: magic, version, message count, then (position, length) of each section
+SECTIONS: tuple = ('offsets', 'names', 'colors', 'records', 'blob', 'name_table', 'color_table')
+HEADER: struct.Struct = struct.Struct('<4sHxxQ' + 'QQ' * len(SECTIONS))
+ALIGNMENT: int = 8
+
+
+class ColumnarChat:
+    """A memory-mapped columnar chat cache.
+
+    Offsets, username indexes and color indexes are stored as flat arrays, usernames and colors are
+    interned in tables, and each message's id and fragments are packed into a blob. Opening a file
+    only reads the header and the two tables; messages are decoded when they are accessed."""
+
+    def __init__(self, filename: str):
+        self.filename: str = filename
+        with open(filename, 'rb') as chat_file:
+            self._mmap: mmap.mmap = mmap.mmap(chat_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header: tuple = HEADER.unpack_from(self._mmap)
+        magic, version, self._count = header[:3]
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f'{filename} is not a version {FORMAT_VERSION} columnar chat cache')
+        self._sections: dict = {name: (header[3 + 2 * index], header[4 + 2 * index])
+                                for index, name in enumerate(SECTIONS)}
+        self._view: memoryview = memoryview(self._mmap)
+        self.offsets = self._array('offsets', 'd')
+        self._names = self._array('names', 'I')
+        self._colors = self._array('colors', 'I')
+        self._records = self._array('records', 'Q')
+        self.name_table: list = json.loads(self._section('name_table').tobytes())
+        self.color_table: list = json.loads(self._section('color_table').tobytes())
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._decode(index) for index in range(*item.indices(self._count))]
+        if item < 0:
+            item += self._count
+        if not 0 <= item < self._count:
+            raise IndexError('message index out of range')
+        return self._decode(item)
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self._decode(index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        for name in ('offsets', '_names', '_colors', '_records', '_view'):
+            view = getattr(self, name, None)
+            if isinstance(view, memoryview):
+                view.release()
+        self._mmap.close()
+
+    def _decode(self, index: int) -> Message:
+        blob_start: int = self._sections.get('blob')[0]
+        record: memoryview = self._view[blob_start + self._records[index]:blob_start + self._records[index + 1]]
+        message_id, fragments = json.loads(record.tobytes())
+        return Message(self.name_table[self._names[index]], message_id, self.color_table[self._colors[index]],
+                       self.offsets[index], tuple(map(fragment_from_dict, fragments)))
+
+    def _section(self, name: str) -> memoryview:
+        position, length = self._sections.get(name)
+        return self._view[position:position + length]
+
+    def _array(self, name: str, typecode: str):
+        if sys.byteorder == 'little':
+            return self._section(name).cast(typecode)
+        values: array = array(typecode, self._section(name).tobytes())
+        values.byteswap()
+        return values
+
+
+def write_columnar(messages, filename: str) -> int:
+    """Write processed messages to a columnar chat cache, streaming them so that only
+    the fixed-size columns are held in memory. Returns the number of messages written."""
+    offsets: array = array('d')
+    names: array = array('I')
+    colors: array = array('I')
+    records: array = array('Q', [0])
+    name_ids: dict = {}
+    color_ids: dict = {}
+    blob_filename: str = filename + '.blob.tmp'
+    with open(blob_filename, 'wb') as blob_file:
+        for message in messages:
+            offsets.append(message.offset)
+            names.append(name_ids.setdefault(message.name, len(name_ids)))
+            colors.append(color_ids.setdefault(message.color, len(color_ids)))
+            blob_file.write(json.dumps([message.id, [fragment.to_dict() for fragment in message.fragments]],
+                                       separators=(',', ':')).encode('utf-8'))
+            records.append(blob_file.tell())
+
+    sections: dict = {
+        'offsets': offsets,
+        'names': names,
+        'colors': colors,
+        'records': records,
+        'name_table': json.dumps(list(name_ids)).encode('utf-8'),
+        'color_table': json.dumps(list(color_ids)).encode('utf-8')
+    }
+    if sys.byteorder != 'little':
+        for column in (offsets, names, colors, records):
+            column.byteswap()
+
+    temp_filename: str = filename + '.tmp'
+    with open(temp_filename, 'wb') as chat_file:
+        chat_file.write(b'\0' * HEADER.size)
+        positions: list = []
+        for name in SECTIONS:
+            chat_file.write(b'\0' * (-chat_file.tell() % ALIGNMENT))
+            start: int = chat_file.tell()
+            if name == 'blob':
+                with open(blob_filename, 'rb') as blob_file:
+                    while chunk := blob_file.read(1 << 20):
+                        chat_file.write(chunk)
+            else:
+                chat_file.write(bytes(sections.get(name)))
+            positions += [start, chat_file.tell() - start]
+        chat_file.seek(0)
+        chat_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(offsets), *positions))
+    os.remove(blob_filename)
+    os.replace(temp_filename, filename)
+    return len(offsets)
+
+
+def main():
+    import argparse
+    from chat_downloader import CACHE_FOLDER, CHAT_EXTENSIONS, convert_chat_cache
+
+    parser = argparse.ArgumentParser(description='Convert cached JSON chats to the columnar format.')
+    parser.add_argument('video_ids', nargs='*', help='videos to convert (default: every cached chat)')
+    parser.add_argument('--keep', action='store_true', help='keep the original JSON cache')
+    args = parser.parse_args()
+
+    json_extensions: tuple = tuple(f'.{extension}' for extension in CHAT_EXTENSIONS if extension != EXTENSION)
+    video_ids: list = args.video_ids or sorted({
+        filename[len('chat-'):].split('.')[0] for filename in os.listdir(CACHE_FOLDER)
+        if filename.startswith('chat-') and filename.endswith(json_extensions)})
+    for video_id in video_ids:
+        chat_filename: str = convert_chat_cache(video_id, keep_original=args.keep)
+        print(f'{video_id}: {chat_filename}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import random
+import re
+import sys
+
+import chat_downloader
+from chat_downloader import EMOJI_MATCHER, EMOJI_PREFIX, UNICODE_MATCHER, calculate_color, color_cache, \
+    process_fragments, replace_unicode, set_bttv_emotes
+from chat_database import join_surrogates
+
+GOLDEN_FILENAME: str = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'golden_fragments.jsonl')
+GOLDEN_MESSAGES: int = 1000
+GOLDEN_EMOJI: tuple = ('\U0001F602', '❤', '\U0001F525')  # Emoji with an image in the emote cache
+GOLDEN_BTTV_EMOTES: tuple = ('LUL', 'FeelsBadMan', 'KKona', 'KKonaW', 'D:', 'SourPls', 'haHAA', 'monkaS', ':tf:')
+# Words that exercise every stage: BTTV emotes alone, inside longer names and glued to text, emoji with and without
+# an image, other characters outside the BMP, and @-mentions in every position and spacing
+GOLDEN_WORDS: tuple = ('hello', 'what', 'is', 'this', 'no', 'way', 'GG', 'LUL', 'LULW', 'xLUL', 'FeelsBadMan',
+                       'KKona', 'KKonaW', 'D:', 'D:D:', 'SourPls', 'haHAA', 'monkaS', ':tf:', '\U0001F602', '❤',
+                       '\U0001F525', '\U0001F62D', 'a\U0001F602b', '\U0001D11E', 'é', '@streamer', '@Mod_Bob',
+                       '@', '@@x', 'mail@host', '(@paren)', '@LUL', '!!!', '?')
+SEPARATORS: tuple = (' ', ' ', ' ', '  ', '\t', '\n', '')
+
+
+def golden_inputs(num_messages: int = GOLDEN_MESSAGES, seed: int = 0) -> list:
+    """Fragment lists shaped like the v5 comments endpoint's"""
+    rng: random.Random = random.Random(seed)
+    inputs: list = []
+    for _ in range(num_messages):
+        fragments: list = []
+        for _ in range(rng.randint(1, 3)):
+            if rng.random() < 0.2:
+                fragments.append({'text': 'Kappa', 'emoticon': {'emoticon_id': '25', 'emoticon_set_id': ''}})
+            else:
+                words: list = [rng.choice(GOLDEN_WORDS) for _ in range(rng.randint(1, 10))]
+                fragments.append({'text': ''.join(word + rng.choice(SEPARATORS) for word in words).strip(' ')
+                                  or '?'})
+        inputs.append(fragments)
+    return inputs
+
+
+def compile_legacy_matcher(emotes) -> re:
+    emotes = sorted((emote for emote in emotes if emote), key=len, reverse=True)
+    return re.compile('|'.join(re.escape(emote) for emote in emotes)) if emotes else None
+
+
+def legacy_process_fragments(fragments: list, bttv_matcher: re, available_emoji: set) -> list:
+    """The four-stage pipeline process_fragments replaced, kept as the reference its output is checked against
+    and the baseline of the processing benchmark"""
+    fragments = legacy_process_bttv_emotes(fragments, bttv_matcher)
+    fragments = legacy_process_emoji(fragments, available_emoji)
+    fragments = legacy_process_unicode(fragments)
+    fragments = legacy_process_usernames(fragments)
+    return fragments
+
+
+def legacy_process_bttv_emotes(old_fragments: list, matcher: re) -> list:
+    fragments: list = []
+    for fragment in old_fragments:
+        if 'emoticon' not in fragment:
+            text: str = fragment.get('text')
+            position: int = 0
+            for match in matcher.finditer(text) if matcher else ():
+                if match.start() > position:
+                    fragments.append({'text': text[position:match.start()]})
+                fragments.append({'text': match.group(), 'emoticon': {'emoticon_id': match.group()}})
+                position = match.end()
+            if position < len(text):
+                fragments.append({'text': text[position:]})
+        else:
+            fragments.append(fragment)
+    return fragments
+
+
+def legacy_process_emoji(old_fragments: list, available_emoji: set) -> list:
+    fragments: list = []
+    for fragment in old_fragments:
+        if 'emoticon' not in fragment:
+            text: str = fragment.get('text')
+            position: int = 0
+            for match in EMOJI_MATCHER.finditer(text):
+                char: str = match.group()
+                if char not in available_emoji:
+                    continue
+                if match.start() > position:
+                    fragments.append({'text': text[position:match.start()]})
+                fragments.append({'text': char, 'emoticon': {'emoticon_id': f'{EMOJI_PREFIX}-{char}'}})
+                position = match.end()
+            if position < len(text):
+                fragments.append({'text': text[position:]})
+        else:
+            fragments.append(fragment)
+    return fragments
+
+
+def legacy_process_unicode(old_fragments: list) -> list:
+    # The old stage checked `'emoticon' not in fragments`, the list, so emote text was encoded too
+    fragments: list = []
+    for fragment in old_fragments:
+        new_fragment: dict = fragment.copy()
+        new_fragment.update({'text': UNICODE_MATCHER.sub(replace_unicode, fragment.get('text'))})
+        fragments.append(new_fragment)
+    return fragments
+
+
+def legacy_process_usernames(old_fragments: list) -> list:
+    fragments: list = []
+    for fragment in old_fragments:
+        if 'emoticon' not in fragment and '@' in fragment.get('text'):
+            tokens: list = re.findall(r'\S+|\s+', fragment.get('text'))
+            prev_index: int = 0
+            for index, token in enumerate(tokens):
+                if token.startswith('@') and len(token) > 1:
+                    text: str = ''.join(tokens[prev_index:index])
+                    if text:
+                        fragments.append({'text': text})
+                    name: str = token[1:].lower()
+                    fragments.append({'text': token, 'tag': calculate_color(name, cache=False)})
+                    prev_index = index + 1
+            text = ''.join(tokens[prev_index:])
+            if text:
+                fragments.append({'text': text})
+        else:
+            fragments.append(fragment)
+    return fragments
+
+
+def normalize(fragments) -> list:
+    """Fragments as dicts, with emotes reduced to their ID: emote text is never rendered, the old pipeline
+    surrogate-encoded it, and the chat caches no longer keep emoticon_set_id. Surrogate pairs are joined, as they are
+    when the fixture or a chat cache is read back from JSON."""
+    return [{'emoticon_id': fragment.get('emoticon').get('emoticon_id')} if 'emoticon' in fragment
+            else {**fragment, 'text': join_surrogates(fragment.get('text'))} for fragment in fragments]
+
+
+def regenerate(filename: str = GOLDEN_FILENAME):
+    """Capture the legacy pipeline's output on the golden inputs: a line with the BTTV emotes and emoji it was run
+    with, then a line per case"""
+    inputs: list = golden_inputs()
+    color_cache.clear()
+    bttv_matcher: re = compile_legacy_matcher(GOLDEN_BTTV_EMOTES)
+    expected: list = [legacy_process_fragments(fragments, bttv_matcher, set(GOLDEN_EMOJI)) for fragments in inputs]
+    with open(filename, 'w', encoding='utf-8') as golden_file:
+        golden_file.write(json.dumps({'bttv_emotes': GOLDEN_BTTV_EMOTES, 'emoji': GOLDEN_EMOJI}) + '\n')
+        for fragments, output in zip(inputs, expected):
+            golden_file.write(json.dumps({'fragments': fragments, 'expected': output}) + '\n')
+
+
+def check(filename: str = GOLDEN_FILENAME) -> tuple:
+    """Run process_fragments over the golden inputs.
+    Returns the number of cases and (case, output) for each whose output differs from the fixture's."""
+    with open(filename, 'r', encoding='utf-8') as golden_file:
+        golden: dict = json.loads(golden_file.readline())
+        cases: list = [json.loads(line) for line in golden_file]
+    bttv_emotes: list = list(chat_downloader.bttv_emotes)
+    emoji_index: set = chat_downloader.emoji_index
+    colors: dict = dict(color_cache)
+    set_bttv_emotes(golden.get('bttv_emotes'))
+    chat_downloader.emoji_index = set(golden.get('emoji'))
+    color_cache.clear()
+    try:
+        mismatches: list = []
+        for case in cases:
+            output: list = normalize(fragment.to_dict() for fragment in process_fragments(case.get('fragments')))
+            if output != normalize(case.get('expected')):
+                mismatches.append((case, output))
+        return len(cases), mismatches
+    finally:
+        set_bttv_emotes(bttv_emotes)
+        chat_downloader.emoji_index = emoji_index
+        color_cache.clear()
+        color_cache.update(colors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check process_fragments against the golden output of the '
+                                                 'pipeline it replaced.')
+    parser.add_argument('--regenerate', action='store_true', help='rewrite the fixture from the legacy pipeline')
+    args = parser.parse_args()
+    if args.regenerate:
+        regenerate()
+        print(f'Wrote {GOLDEN_FILENAME}.')
+        return
+
+    num_cases, mismatches = check()
+    for case, output in mismatches[:10]:
+        print(f'MISMATCH {case.get("fragments")!r}\n'
+              f'  expected {normalize(case.get("expected"))!r}\n'
+              f'  got      {output!r}')
+    if mismatches:
+        print(f'{len(mismatches)} of {num_cases} cases differ.')
+        sys.exit(1)
+    print(f'All {num_cases} cases match.')
+
+if __name__ == '__main__':
+    main()
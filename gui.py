@@ -1,15 +1,18 @@
-import os
 from tkinter import Tk, BOTH, TOP, LEFT, RIGHT, X, S, HORIZONTAL, Canvas, VERTICAL, Y, BOTTOM, N, W, NSEW, Toplevel, \
     SOLID, Text, IntVar, StringVar, BooleanVar, DoubleVar, DISABLED, END, WORD, PhotoImage, TclError, NORMAL
 from tkinter.ttk import Frame, Button, Scale, Scrollbar, Label, Checkbutton, Separator, Style, Entry, Progressbar
 from tkinter.font import Font, BOLD
-from chat_downloader import get_emote, video_exists, parse_url, ChatDownloader, UNICODE_MATCHER, CACHE_FOLDER, default_colors
+from chat_downloader import get_emote, video_exists, parse_url, ChatDownloader, UNICODE_MATCHER, default_colors, \
+    find_chat_cache, is_cached
 import re
 from PIL import Image, ImageTk
 
-from message_store import MessageStore
+from activity import ActivityIndex
+from message_store import MessageStore, WindowedMessageStore
 
 DEFAULT_FONT_SIZE: int = 13
+HEATMAP_HEIGHT: int = 6
+HEATMAP_BIN_PIXELS: int = 2
 
 
 class ChatPlayer(Frame):
@@ -124,13 +127,50 @@ class TimeFrame(Frame):
 
         self.time_elapsed_label = Label(self, relief=SOLID, borderwidth=1, padding=3)
         self.time_elapsed_label.pack(side=LEFT, padx=8)
-        self.time_scale = ClickableScale(self, orient=HORIZONTAL, takefocus=False)
-        self.time_scale.pack(side=LEFT, fill=BOTH, expand=True)
+        self.scale_frame = Frame(self)
+        self.scale_frame.pack(side=LEFT, fill=BOTH, expand=True)
+        self.heatmap = ActivityHeatmap(self.scale_frame)
+        self.heatmap.pack(side=TOP, fill=X)
+        self.time_scale = ClickableScale(self.scale_frame, orient=HORIZONTAL, takefocus=False)
+        self.time_scale.pack(side=TOP, fill=BOTH, expand=True)
         self.end_time_label = Label(self, text='1:20:18', relief=SOLID, borderwidth=1, padding=3)
         self.end_time_label.pack(side=LEFT, padx=8)
         # Separator(self, orient=VERTICAL).pack(side=LEFT, fill=Y, pady=4)
 
 
+class ActivityHeatmap(Canvas):
+    """A strip along the time scale shaded by how much chat there is at each point of the VOD"""
+
+    def __init__(self, master, **kwargs):
+        Canvas.__init__(self, master, height=HEATMAP_HEIGHT, highlightthickness=0, **kwargs)
+        self.activity: ActivityIndex = None
+        self.duration: float = 0
+        self.bind('<Configure>', lambda _: self.draw())
+
+    def set_activity(self, activity: ActivityIndex, duration: float):
+        self.activity = activity
+        self.duration = duration
+        self.draw()
+
+    def draw(self):
+        self.delete('all')
+        width: int = self.winfo_width()
+        if self.activity is None or not self.duration or width <= 1:
+            return
+        densities: list = self.activity.densities(width // HEATMAP_BIN_PIXELS, self.duration)
+        peak: int = max(densities, default=0) or 1
+        for index, density in enumerate(densities):
+            if density:
+                x: int = index * HEATMAP_BIN_PIXELS
+                self.create_rectangle(x, 0, x + HEATMAP_BIN_PIXELS, HEATMAP_HEIGHT, width=0,
+                                      fill=heat_color(density / peak))
+
+
+def heat_color(level: float) -> str:
+    """From pale yellow for a little chat to red for the busiest moments"""
+    return f'#ff{int(240 * (1 - level)):02x}{int(160 * (1 - level)):02x}'
+
+
 class ChatText(Text):
     def __init__(self, master, **kwargs):
         self.master = Frame(master)
@@ -169,16 +209,20 @@ class ChatText(Text):
         self.insert(END, username, color)
         self.insert(END, ' : ')
         for fragment in fragments:
-            if 'emoticon' in fragment:
-                emote_id = fragment.get('emoticon').get('emoticon_id')
+            if fragment.emote_id is not None:
+                emote_id = fragment.emote_id
                 image = self.images.get(emote_id)
                 if image is None:
-                    image_path = get_emote(emote_id)
-                    image = ImageTk.PhotoImage(Image.open(image_path))
+                    try:
+                        image = ImageTk.PhotoImage(Image.open(get_emote(emote_id)))
+                    except OSError:
+                        # Show the emote's name when its image isn't cached and can't be fetched
+                        self.insert(END, fragment.text, fragment.tag)
+                        continue
                     self.images[emote_id] = image
                 self.image_create(END, image=image, padx=2, pady=2)
             else:
-                self.insert(END, fragment.get('text'), fragment.get('tag'))
+                self.insert(END, fragment.text, fragment.tag)
         if autoscroll:
             self.yview_moveto(1.0)
         self.insert(END, '\n')
@@ -270,8 +314,7 @@ class DownloadPopup(Toplevel):
             self.entry.insert(0, video_id)
             self.overwrite_cache_check.focus_set()
 
-            chat_filename: str = os.path.join(CACHE_FOLDER, f'chat-{video_id}.json')
-            if not os.path.exists(chat_filename):
+            if not find_chat_cache(video_id):
                 self.ok()
 
     def cancel(self):
@@ -289,10 +332,22 @@ class DownloadPopup(Toplevel):
 
     def validate(self):
         video_id: str = self.entry.get()
-        if 'http' in video_id or 'twitch.tv' in video_id:
-            video_id = parse_url(video_id)
-        if len(video_id) > 0 and video_exists(video_id):
-            self.chat_downloader = ChatDownloader(video_id, overwrite_cache=self.overwrite_cache_var.get())
+        try:
+            if 'http' in video_id or 'twitch.tv' in video_id:
+                video_id = parse_url(video_id)
+            # Only ask Twitch whether the video exists if it has to be downloaded
+            cached: bool = len(video_id) > 0 and not self.overwrite_cache_var.get() and is_cached(video_id)
+            exists: bool = len(video_id) > 0 and (cached or video_exists(video_id))
+        except ValueError:
+            exists = False
+        except OSError:
+            self.status_var.set("Error: Couldn't check the video with Twitch.")
+            self.button.config(state=NORMAL)
+            return
+        if exists:
+            self.chat_downloader = ChatDownloader(video_id, overwrite_cache=self.overwrite_cache_var.get(),
+                                                  database=getattr(self.message_store, 'database', None),
+                                                  lazy=isinstance(self.message_store, WindowedMessageStore))
             self.chat_downloader.start()
             self.after(1, self.download)
         else:
@@ -303,7 +358,7 @@ class DownloadPopup(Toplevel):
         if not self.chat_downloader.info:
             self.status_var.set('Getting info')
             self.after(100, self.download)
-        elif not self.chat_downloader.messages:
+        elif self.chat_downloader.is_alive() and not self.chat_downloader.messages:
             if not self.updated_info:
                 self.status_var.set('Downloading chat')
                 self.info.update(self.chat_downloader.info)
@@ -316,7 +371,10 @@ class DownloadPopup(Toplevel):
             self.eta_var.set(f'ETA: {self.chat_downloader.eta_str}')
             self.after(100, self.download)
         else:
-            self.message_store.set_messages(self.chat_downloader.messages)
+            self.info.update(self.chat_downloader.info)
+            # The rest of the chat keeps loading in the background
+            self.message_store.set_messages(self.chat_downloader.messages, self.chat_downloader.video_id,
+                                            self.chat_downloader.loaded)
             self.destroy()
 
 
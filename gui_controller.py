@@ -1,13 +1,26 @@
+import os
 import traceback
+from bisect import bisect_left, bisect_right
+from math import ceil, floor
 
 from gui import ChatPlayer, DownloadPopup, DEFAULT_FONT_SIZE, ErrorMessage
-from chat_downloader import ChatDownloader, parse_url, video_exists
+from chat_downloader import ChatDownloader, parse_url, video_exists, get_chat_cache, get_highlights, DATABASE_FILENAME
+from chat_database import ChatDatabase
 from clock import Clock
 from tkinter import Tk, END, UNITS
-from message_store import MessageStore
+from message import Message
+from message_store import MessageStore, SQLiteMessageStore, WindowedMessageStore
 import sys
 
-TICK_MS = 50
+MAX_FPS = 30  # Messages arriving faster than this are shown together, in one render per frame
+FRAME_MS = 1000 // MAX_FPS
+HEATMAP_REFRESH_MS = 1000
+HIGHLIGHT_TERMS: tuple = ()  # Emotes or keywords whose own spikes are highlights too, like ('KEKW', 'clip it')
+HIGHLIGHT_LEAD_SECONDS: float = 5  # How long before a highlight jumping to it lands
+HIGHLIGHT_REPEAT_SECONDS: float = 3  # Jumping back within this long after a highlight goes to the one before it
+# 'memory', 'windowed' to only decode messages near the playhead,
+# or 'sqlite' to keep every chat in one database instead of loading it into RAM
+MESSAGE_STORE = 'memory'
 
 
 class GuiController:
@@ -17,6 +30,7 @@ class GuiController:
         self.gui_root.geometry(self.geometry)
         self.gui: ChatPlayer = ChatPlayer(self.gui_root)
         self.previous_tick: float = 0
+        self.tick_job: str = None
         self.scrubbing: bool = False
         self.search_open: bool = True
         self.search_focused: bool = False
@@ -25,8 +39,15 @@ class GuiController:
         self.clock.start()
         self.clock.pause()
         self.info: dict = {'title': 'Chat Player'}
-        self.message_store: MessageStore = MessageStore([])
+        if MESSAGE_STORE == 'sqlite':
+            os.makedirs(os.path.dirname(DATABASE_FILENAME), exist_ok=True)
+            self.message_store: MessageStore = SQLiteMessageStore(ChatDatabase(DATABASE_FILENAME))
+        elif MESSAGE_STORE == 'windowed':
+            self.message_store = WindowedMessageStore([])
+        else:
+            self.message_store = MessageStore([])
         self.duration: int = 0
+        self.highlight_times: list = []
         self.gui_root.bind_all('<Control-n>', lambda _: self._configure_vid_info())
         self.gui_root.bind_all('<Control-w>', lambda _: self.exit())
         self.gui_root.bind_all('<Pause>', lambda _: self.exit())
@@ -36,7 +57,14 @@ class GuiController:
         self._configure_vid_info(video_id)
 
     def _configure_vid_info(self, video_id=None):
+        previous_video_id: str = self.message_store.video_id
         self.get_input(self.info, self.message_store, video_id)
+        if self.message_store.video_id != previous_video_id:
+            # Keep the open chat from being evicted from the cache
+            if previous_video_id:
+                get_chat_cache().unpin(previous_video_id)
+            if self.message_store.video_id:
+                get_chat_cache().pin(self.message_store.video_id)
         self.skip_to_time(0)
         if self.message_store.messages:
             self.duration: int = self.info.get('length')
@@ -79,6 +107,8 @@ class GuiController:
             '<j>': lambda _: self.skip_to_time(self.gui.seconds_elapsed_var.get() - 10),
             '<k>': lambda _: self.toggle_pause(),
             '<l>': lambda _: self.skip_to_time(self.gui.seconds_elapsed_var.get() + 10),
+            'n': lambda _: self.skip_to_highlight(),
+            'N': lambda _: self.skip_to_highlight(forward=False),
             '+': lambda _: self.update_font_size(1),
             '-': lambda _: self.update_font_size(-1)
         }
@@ -95,6 +125,7 @@ class GuiController:
         self.gui.time_frame.play_pause_button.configure(command=lambda: self.toggle_pause())
         self.gui.time_frame.end_time_label.configure(text=format_seconds(self.duration))
         self.gui.time_frame.time_scale.configure(to=self.duration)
+        self.refresh_heatmap()
         self.gui.time_frame.time_scale.configure(
             command=lambda _: self.skip_to_time(self.gui.seconds_elapsed_var.get()))
         self.gui.time_frame.time_scale.bind('<Button-3>', lambda _: self.scrub(True))
@@ -118,42 +149,96 @@ class GuiController:
 
         if self.search_open:
             self.toggle_search()
-        self.gui.after(TICK_MS, self.tick_clock)
+
+    def refresh_heatmap(self):
+        """Draw the chat activity along the time scale, redrawing it until the chat has finished loading"""
+        self.gui.time_frame.heatmap.set_activity(self.message_store.activity(), self.duration)
+        loaded = getattr(self.message_store, 'loaded', None)
+        if loaded is not None and not loaded.is_set():
+            self.gui.after(HEATMAP_REFRESH_MS, self.refresh_heatmap)
+        else:
+            self.load_highlights()
+
+    def load_highlights(self):
+        """Find the spikes in chat, or read them from the cache, once the whole chat is loaded"""
+        highlights: list = get_highlights(self.message_store.video_id, self.message_store, HIGHLIGHT_TERMS) \
+            if self.message_store.video_id else []
+        self.highlight_times = sorted(max(0.0, highlight.get('offset') - HIGHLIGHT_LEAD_SECONDS)
+                                      for highlight in highlights)
+
+    def skip_to_highlight(self, forward: bool = True):
+        current_time: float = self.gui.seconds_elapsed_var.get()
+        if forward:
+            index: int = bisect_right(self.highlight_times, current_time + 0.5)
+        else:
+            index = bisect_left(self.highlight_times, current_time - HIGHLIGHT_REPEAT_SECONDS) - 1
+        if 0 <= index < len(self.highlight_times):
+            self.skip_to_time(self.highlight_times[index])
 
     def tick_clock(self):
+        self.tick_job = None
+        if self.gui.paused_var.get() or self.scrubbing:
+            return
+        current_tick = self.clock.elapsed_time
+        if current_tick > self.duration:
+            # self.skip_to_time(0)
+            self.toggle_pause()
+            self.set_time(0)
+            self.previous_tick = 0
+            return
+        self.show_time(current_tick)
+        if not self.previous_tick:
+            messages = self.message_store.get(current_tick, current_tick, earlier_messages=50)
+        else:
+            messages = self.message_store.get(self.previous_tick, current_tick)
+        self.display_messages(messages)
+        self.previous_tick = current_tick
+        self.schedule_tick(self.next_tick_delay(current_tick))
+
+    def next_tick_delay(self, current_tick: float) -> int:
+        """Milliseconds until the next message is due or the time display next changes, whichever is first,
+        but at least a frame, so a burst of messages is shown a frame at a time"""
+        next_second: float = floor(current_tick) + 1
+        next_offset: float = self.message_store.next_offset(current_tick)
+        next_tick: float = next_second if next_offset is None else min(next_offset, next_second)
+        return max(FRAME_MS, ceil((next_tick - current_tick) / self.clock.speed * 1000))
+
+    def schedule_tick(self, delay_ms: int = 0):
+        """Replace the pending tick with one after delay_ms, unless playback is paused"""
+        self.cancel_tick()
         if not self.gui.paused_var.get() and not self.scrubbing:
-            current_tick = self.clock.elapsed_time
-            if current_tick > self.duration:
-                # self.skip_to_time(0)
-                self.toggle_pause()
-                current_tick = 0
-            self.set_time(current_tick)
-            if not self.previous_tick:
-                messages = self.message_store.get(current_tick, current_tick, earlier_messages=50)
-            else:
-                messages = self.message_store.get(self.previous_tick, current_tick)
+            self.tick_job = self.gui.after(delay_ms, self.tick_clock)
 
-            self.gui_root.after(1, lambda: self.display_messages(messages))
-            self.previous_tick = current_tick
-        self.gui.after(TICK_MS, self.tick_clock)
+    def cancel_tick(self):
+        if self.tick_job is not None:
+            self.gui.after_cancel(self.tick_job)
+            self.tick_job = None
 
     def scrub(self, state: bool):
         self.scrubbing = state
+        if not state:
+            self.schedule_tick()
 
     def focus_search(self, state: bool):
         self.search_focused = state
 
     def set_time(self, seconds: float):
+        """Seek the clock to `seconds` and show it"""
         if seconds >= 0:
             self.clock.set_elapsed_time(seconds)
-            self.gui.seconds_elapsed_var.set(seconds)
-            self.gui.time_display_var.set(format_seconds(seconds))
+            self.show_time(seconds)
+
+    def show_time(self, seconds: float):
+        """Show the time without touching the clock, which would drop the time since it was read"""
+        self.gui.seconds_elapsed_var.set(seconds)
+        self.gui.time_display_var.set(format_seconds(seconds))
 
     def skip_to_time(self, seconds: float):
         if 0 <= seconds <= self.duration:
             self.gui.chat_text.clear()
             self.set_time(seconds)
             self.previous_tick = None
+            self.schedule_tick()
         else:
             self.skip_to_time(0.0)
 
@@ -175,21 +260,25 @@ class GuiController:
             if speed > 0:
                 self.gui.speed_display_var.set(f'{speed:.2f}')
                 self.clock.speed = speed
+                self.schedule_tick()
         else:
             new_speed = float(self.gui.speed_display_var.get()) + speed
             if new_speed > 0:
                 self.gui.speed_display_var.set(f'{new_speed:.2f}')
                 self.clock.speed += speed
+                self.schedule_tick()
 
     def toggle_pause(self):
         self.gui.paused_var.set(not self.gui.paused_var.get())
         paused = self.gui.paused_var.get()
         if paused:
             self.clock.pause()
+            self.cancel_tick()
             self.gui.pause_button_text_var.set('⏵')
         else:
             self.clock.resume()
             self.gui.pause_button_text_var.set('⏸')
+            self.schedule_tick()
 
     def toggle_search(self):
         self.set_new_search()
@@ -243,10 +332,10 @@ class GuiController:
         for message in messages:
             self.display_message(message)
 
-    def display_message(self, message_dict: dict):
-        username = message_dict.get('name')
-        fragments = message_dict.get('fragments')
-        color = message_dict.get('color')
+    def display_message(self, message: Message):
+        username = message.name
+        fragments = message.fragments
+        color = message.color
         self.gui.chat_text.append_message(username, fragments, color, autoscroll=self.gui.autoscroll_var.get())
 
     def run(self, geometry=None):
@@ -254,6 +343,7 @@ class GuiController:
         self.gui_root.mainloop()
 
     def exit(self):
+        self.cancel_tick()
         self.clock.stop()
         self.gui_root.quit()
 
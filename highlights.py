@@ -0,0 +1,111 @@
+from bisect import bisect_left, insort
+from math import sqrt
+
+from activity import ActivityIndex
+
+HIGHLIGHTS_VERSION: int = 1  # Bump whenever find_highlights changes what it finds
+WINDOW_SECONDS: float = 10  # Length of the windows whose message rate is compared with the baseline
+BASELINE_SECONDS: float = 300  # Length of the baseline on either side of a window
+MIN_SCORE: float = 4  # Standard deviations above the baseline a window has to be to count as a spike
+MIN_MESSAGES: int = 10  # Fewest messages a window needs to count as a spike, so quiet chats don't spike on a few
+MIN_GAP_SECONDS: float = 60  # Spikes closer together than this are one highlight
+MAX_HIGHLIGHTS: int = 100
+
+
+def find_spikes(activity: ActivityIndex, term: str = None, window_seconds: float = WINDOW_SECONDS,
+                baseline_seconds: float = BASELINE_SECONDS, min_score: float = MIN_SCORE,
+                min_messages: int = MIN_MESSAGES) -> list:
+    """Every window where the message rate is well above the rate around it, best first.
+
+    Window and baseline counts are differences of the index's prefix sums, so every window costs the same
+    however long the windows are. Chat is treated as a Poisson process, so a window's score is how many standard
+    deviations its count is above what the baseline on either side of it predicts."""
+    prefix_sums = activity.prefix_sums
+    num_buckets: int = len(prefix_sums) - 1
+    window: int = max(1, round(window_seconds / activity.bucket_seconds))
+    baseline: int = max(1, round(baseline_seconds / activity.bucket_seconds))
+    if num_buckets < window:
+        return []
+
+    window_counts: list = [end - start for start, end in zip(prefix_sums, prefix_sums[window:])]
+    spikes: list = []
+    for bucket, count in enumerate(window_counts):
+        if count < min_messages:
+            continue
+        baseline_start: int = max(0, bucket - baseline)
+        baseline_end: int = min(num_buckets, bucket + window + baseline)
+        baseline_buckets: int = baseline_end - baseline_start - window
+        if not baseline_buckets:
+            continue
+        baseline_count: int = prefix_sums[baseline_end] - prefix_sums[baseline_start] - count
+        expected: float = baseline_count / baseline_buckets * window
+        score: float = (count - expected) / sqrt(expected + 1)
+        if score >= min_score:
+            spikes.append({'offset': bucket * activity.bucket_seconds, 'messages': count,
+                           'expected': round(expected, 1), 'score': round(score, 2), 'term': term})
+    spikes.sort(key=lambda spike: spike.get('score'), reverse=True)
+    return spikes
+
+
+def find_highlights(message_store, terms: tuple = (), min_gap_seconds: float = MIN_GAP_SECONDS,
+                    max_highlights: int = MAX_HIGHLIGHTS) -> list:
+    """The best spikes in the message rate of a chat, and in the rate of each of `terms`, like an emote or a
+    keyword, best first. Of the spikes within min_gap_seconds of each other only the best is kept."""
+    spikes: list = find_spikes(message_store.activity())
+    for term in terms:
+        spikes.extend(find_spikes(message_store.activity(term), term=term))
+    spikes.sort(key=lambda spike: spike.get('score'), reverse=True)
+
+    highlights: list = []
+    taken: list = []  # Offsets of the highlights so far, sorted
+    for spike in spikes:
+        index: int = bisect_left(taken, spike.get('offset'))
+        if index < len(taken) and taken[index] - spike.get('offset') < min_gap_seconds \
+                or index > 0 and spike.get('offset') - taken[index - 1] < min_gap_seconds:
+            continue
+        highlights.append(spike)
+        insort(taken, spike.get('offset'))
+        if len(highlights) >= max_highlights:
+            break
+    return highlights
+
+
+def parameters(terms: tuple = ()) -> dict:
+    """What the highlights of a chat depend on besides the chat, to tell whether cached ones are still valid"""
+    return {
+        'version': HIGHLIGHTS_VERSION,
+        'terms': list(terms),
+        'window_seconds': WINDOW_SECONDS,
+        'baseline_seconds': BASELINE_SECONDS,
+        'min_score': MIN_SCORE,
+        'min_messages': MIN_MESSAGES,
+        'min_gap_seconds': MIN_GAP_SECONDS,
+        'max_highlights': MAX_HIGHLIGHTS
+    }
+
+
+def main():
+    import argparse
+    from chat_downloader import find_chat_cache, format_seconds, get_highlights, load_chat
+    from message_store import MessageStore
+
+    parser = argparse.ArgumentParser(description='List the moments where chat spikes in a cached VOD.')
+    parser.add_argument('video_id')
+    parser.add_argument('-t', '--term', action='append', default=[],
+                        help='an emote or keyword whose own spikes count too (repeatable)')
+    parser.add_argument('-n', type=int, default=20, help='how many highlights to list')
+    args = parser.parse_args()
+
+    video_id: str = args.video_id[1:] if args.video_id.startswith('v') else args.video_id
+    chat_filename: str = find_chat_cache(video_id)
+    if chat_filename is None:
+        parser.error(f'No cached chat for video {video_id}')
+    message_store: MessageStore = MessageStore(load_chat(chat_filename))
+    for rank, highlight in enumerate(get_highlights(video_id, message_store, tuple(args.term))[:args.n], 1):
+        term: str = f' "{highlight.get("term")}"' if highlight.get('term') else ''
+        print(f'{rank:>3}. {format_seconds(highlight.get("offset"))}  {highlight.get("messages")}{term} messages '
+              f'in {WINDOW_SECONDS:g}s, {highlight.get("expected")} expected ({highlight.get("score"):.1f} sd)')
+
+
+if __name__ == '__main__':
+    main()
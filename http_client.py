@@ -0,0 +1,189 @@
+import asyncio
+import json
+import random
+from threading import Lock
+from time import sleep, time, monotonic
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE: int = 16
+TIMEOUT: tuple = (5, 30)  # (connect, read) seconds
+MAX_RETRIES: int = 5
+BACKOFF_BASE: float = 0.5
+BACKOFF_MAX: float = 30
+RETRY_STATUSES: set = {429, 500, 502, 503, 504}
+RATE_LIMIT_RESERVE: int = 10  # Start pacing when this few requests remain in the window
+MAX_CONCURRENCY: int = 32
+
+
+class HttpStatusError(OSError):
+    """A response with an error status that retrying didn't fix, like requests' HTTPError for AsyncHttpClient"""
+
+    def __init__(self, status: int, url: str):
+        super().__init__(f'{status} response from {url}')
+        self.status: int = status
+        self.url: str = url
+
+
+class RateLimitPacer:
+    """Hands out request start times, spreading the requests remaining in
+    the rate limit window evenly until it resets"""
+
+    def __init__(self):
+        self._lock: Lock = Lock()
+        self._request_interval: float = 0.0
+        self._next_request_time: float = 0.0
+
+    def reserve(self) -> float:
+        """Reserve the next request slot and return how long to wait for it"""
+        with self._lock:
+            now: float = monotonic()
+            start: float = max(now, self._next_request_time)
+            self._next_request_time = start + self._request_interval
+        return start - now
+
+    def update(self, headers):
+        remaining: str = headers.get('Ratelimit-Remaining')
+        reset: str = headers.get('Ratelimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining_count: int = int(remaining)
+            seconds_to_reset: float = float(reset) - time()
+        except ValueError:
+            return
+        with self._lock:
+            if remaining_count > RATE_LIMIT_RESERVE or seconds_to_reset <= 0:
+                self._request_interval = 0.0
+            else:
+                self._request_interval = seconds_to_reset / max(remaining_count, 1)
+
+
+class HttpClient:
+    """A pooled, keep-alive HTTP client that retries transient failures
+    and paces requests according to the rate limit headers"""
+
+    def __init__(self, headers: dict = None, pool_size: int = POOL_SIZE, timeout: tuple = TIMEOUT,
+                 max_retries: int = MAX_RETRIES):
+        self.session: requests.Session = requests.Session()
+        adapter: HTTPAdapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self.timeout: tuple = timeout
+        self.max_retries: int = max_retries
+        self.pacer: RateLimitPacer = RateLimitPacer()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request, retrying connection errors and retryable statuses with exponential backoff"""
+        kwargs.setdefault('timeout', self.timeout)
+        attempt: int = 0
+        while True:
+            sleep(self.pacer.reserve())
+            try:
+                response: requests.Response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            self.pacer.update(response.headers)
+            if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                return response
+            sleep(max(retry_after(response.status_code, response.headers), backoff_delay(attempt)))
+            attempt += 1
+
+
+class AsyncHttpClient:
+    """The asyncio counterpart of HttpClient. All requests made through one client
+    share a connection pool and a global concurrency limit, so any number of
+    downloads can be multiplexed on a single event loop."""
+
+    def __init__(self, headers: dict = None, max_concurrency: int = MAX_CONCURRENCY, timeout: tuple = TIMEOUT,
+                 max_retries: int = MAX_RETRIES):
+        self.headers: dict = headers or {}
+        self.max_concurrency: int = max_concurrency
+        self.timeout: tuple = timeout
+        self.max_retries: int = max_retries
+        self.pacer: RateLimitPacer = RateLimitPacer()
+        self.session: aiohttp.ClientSession = None
+        self._semaphore: asyncio.Semaphore = None
+
+    async def __aenter__(self):
+        connect_timeout, read_timeout = self.timeout
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+        return self
+
+    async def __aexit__(self, *_):
+        await self.session.close()
+
+    async def get_json(self, url: str):
+        """The parsed body of a successful response. Raises HttpStatusError for any other status."""
+        return json.loads(await self.get_bytes(url))
+
+    async def get_bytes(self, url: str) -> bytes:
+        """The body of a successful response. Raises HttpStatusError for any other status."""
+        status, _, body = await self.request('GET', url)
+        if not 200 <= status < 300:
+            raise HttpStatusError(status, url)
+        return body
+
+    async def request(self, method: str, url: str) -> tuple:
+        """Send a request, retrying like HttpClient.request. Returns (status, headers, body)."""
+        attempt: int = 0
+        while True:
+            await asyncio.sleep(self.pacer.reserve())
+            try:
+                async with self._semaphore:
+                    async with self.session.request(method, url) as response:
+                        body: bytes = await response.read()
+                        status: int = response.status
+                        headers = response.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            self.pacer.update(headers)
+            if status not in RETRY_STATUSES or attempt >= self.max_retries:
+                return status, headers, body
+            await asyncio.sleep(max(retry_after(status, headers), backoff_delay(attempt)))
+            attempt += 1
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after(status_code: int, headers) -> float:
+    """Seconds the server asked us to wait, from Retry-After or the rate limit reset"""
+    header: str = headers.get('Retry-After')
+    if header is None and status_code == 429:
+        reset: str = headers.get('Ratelimit-Reset')
+        if reset is not None:
+            try:
+                return max(0.0, float(reset) - time())
+            except ValueError:
+                return 0.0
+    try:
+        return float(header) if header is not None else 0.0
+    except ValueError:
+        return 0.0
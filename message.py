@@ -0,0 +1,90 @@
+from sys import intern
+
+
+class Fragment:
+    """A piece of a message: plain text, an @-mention tagged with a color, or an emote.
+    Emote fragments are flyweights shared by every message that uses the same emote, so they must not be modified."""
+    __slots__ = ('text', 'emote_id', 'tag')
+
+    def __init__(self, text: str, emote_id: str = None, tag: str = None):
+        self.text: str = text
+        self.emote_id: str = emote_id
+        self.tag: str = tag
+
+    def to_dict(self) -> dict:
+        """The fragment in the JSON shape of the chat caches"""
+        if self.emote_id is not None:
+            return {'text': self.text, 'emoticon': {'emoticon_id': self.emote_id}}
+        if self.tag is not None:
+            return {'text': self.text, 'tag': self.tag}
+        return {'text': self.text}
+
+    def __eq__(self, other):
+        if not isinstance(other, Fragment):
+            return NotImplemented
+        return (self.text, self.emote_id, self.tag) == (other.text, other.emote_id, other.tag)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Fragment({self.text!r}, emote_id={self.emote_id!r}, tag={self.tag!r})'
+
+
+class Message:
+    """A processed chat message. Usernames and colors are interned, and fragments are a tuple."""
+    __slots__ = ('name', 'id', 'color', 'offset', 'fragments')
+
+    def __init__(self, name: str, message_id: str, color: str, offset: float, fragments: tuple):
+        self.name: str = intern(name) if name else name
+        self.id: str = message_id
+        self.color: str = intern(color) if color else color
+        self.offset: float = offset
+        self.fragments: tuple = fragments
+
+    @property
+    def text(self) -> str:
+        """The message as it was typed, with emotes as their names"""
+        return ''.join(fragment.text for fragment in self.fragments)
+
+    def to_dict(self) -> dict:
+        """The message in the JSON shape of the chat caches"""
+        return {
+            'name': self.name,
+            'id': self.id,
+            'color': self.color,
+            'offset': self.offset,
+            'fragments': [fragment.to_dict() for fragment in self.fragments]
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Message({self.name!r}, {self.id!r}, {self.color!r}, {self.offset!r}, {self.fragments!r})'
+
+
+emote_fragments: dict = {}
+
+
+def emote_fragment(text: str, emote_id: str) -> Fragment:
+    """The shared fragment for an emote"""
+    fragment: Fragment = emote_fragments.get((text, emote_id))
+    if fragment is None:
+        fragment = emote_fragments.setdefault((text, emote_id), Fragment(intern(text), intern(emote_id)))
+    return fragment
+
+
+def fragment_from_dict(data: dict) -> Fragment:
+    emoticon: dict = data.get('emoticon')
+    if emoticon:
+        return emote_fragment(data.get('text'), emoticon.get('emoticon_id'))
+    return Fragment(data.get('text'), tag=data.get('tag'))
+
+
+def message_from_dict(data: dict) -> Message:
+    return Message(data.get('name'), data.get('id'), data.get('color'), data.get('offset'),
+                   tuple(fragment_from_dict(fragment) for fragment in data.get('fragments')))
@@ -1,36 +1,203 @@
+from array import array
+from bisect import bisect_left
+from threading import Event
+
+from activity import ActivityIndex, term_offsets
+from chat_database import ChatDatabase
+from columnar_chat import ColumnarChat
+
+PREFETCH_MESSAGES: int = 2000  # Messages decoded ahead of the playhead, in the direction of playback
+KEEP_BEHIND_MESSAGES: int = 500  # Messages kept decoded behind the playhead
+LOAD_WAIT_SECONDS: float = 0.2  # How long get waits for a chat that is still loading to reach end_second
+
+
 class MessageStore:
     def __init__(self, messages: list):
         self.messages: list = messages
-        self.pointer: int = 0
+        self.offsets = array('d')
+        self.video_id: str = None
+        self.loaded: Event = None
+        self._activity: ActivityIndex = None
+        self.set_messages(messages)
 
     def get(self, start_second: float, end_second: float, earlier_messages: int = 0):
         if start_second < 0:
             return None
 
-        # If the pointer is ahead of start_second, move it back
-        while self.pointer > 0 and self.messages[self.pointer - 1].get('offset') >= start_second:
-            self.pointer -= 1
+        # If the chat is still being loaded and hasn't reached end_second, give the loader a moment
+        if self.loaded is not None and not self.loaded.is_set() \
+                and (not self.messages or self.messages[-1].offset < end_second):
+            self.loaded.wait(LOAD_WAIT_SECONDS)
+        self._index_new_messages()
 
-        # If the pointer is behind start_second, move it forward
-        while self.pointer < len(self.messages) - 1 and self.messages[self.pointer + 1].get('offset') < start_second:
-            self.pointer += 1
+        first: int = max(0, bisect_left(self.offsets, start_second) - earlier_messages)
+        last: int = bisect_left(self.offsets, end_second, lo=first)
+        return self.messages[first:last]
 
-        # If we want earlier messages, move the pointer back
-        if earlier_messages:
-            self.pointer -= earlier_messages
-            if self.pointer < 0:
-                self.pointer = 0
+    def next_offset(self, second: float) -> float:
+        """The offset of the first message at or after `second`, or None if there isn't one loaded yet"""
+        self._index_new_messages()
+        index: int = bisect_left(self.offsets, second)
+        return self.offsets[index] if index < len(self.offsets) else None
 
+    def set_messages(self, messages: list, video_id: str = None, loaded: Event = None):
+        """Replace the messages, indexing their offsets for binary search.
+        If they are still being appended to, `loaded` is set once they are all there, and new ones are indexed as
+        they arrive."""
+        self.messages = messages
+        offsets = getattr(messages, 'offsets', None)
+        self.offsets = offsets if offsets is not None else array('d', (message.offset for message in messages))
+        self.video_id = video_id
+        self.loaded = loaded
+        self._activity = None
+
+    def activity(self, term: str = None) -> ActivityIndex:
+        """Message counts over time, built on first use and rebuilt once more messages have loaded.
+        With a term, counts only the messages containing it."""
+        self._index_new_messages()
+        if term:
+            duration: float = self.offsets[-1] if len(self.offsets) else 0
+            return ActivityIndex.from_offsets(term_offsets(self.messages, term), duration=duration)
+        if self._activity is None or self._activity.prefix_sums[-1] != len(self.offsets):
+            self._activity = ActivityIndex.from_offsets(self.offsets)
+        return self._activity
+
+    def _index_new_messages(self):
+        if len(self.offsets) < len(self.messages):
+            self.offsets.extend(message.offset for message in self.messages[len(self.offsets):])
+
+    def __getitem__(self, item):
+        return self.messages[item]
+
+
+class SQLiteMessageStore:
+    """A MessageStore backed by a ChatDatabase, answering each get with an indexed range query
+    instead of holding the chat in memory"""
+
+    def __init__(self, database: ChatDatabase, video_id: str = None):
+        self.database: ChatDatabase = database
+        self.video_id: str = video_id
+        self._count: int = database.count(video_id) if video_id else 0
+        self._activity: ActivityIndex = None
+
+    @property
+    def messages(self):
+        return self
+
+    def get(self, start_second: float, end_second: float, earlier_messages: int = 0):
+        if start_second < 0:
+            return None
         results: list = []
-        while self.pointer < len(self.messages) and self.messages[self.pointer].get('offset') < end_second:
-            results.append(self.messages[self.pointer])
-            self.pointer += 1
+        if earlier_messages:
+            results = self.database.get_before(self.video_id, start_second, earlier_messages)
+        return results + self.database.get_range(self.video_id, start_second, end_second)
+
+    def next_offset(self, second: float) -> float:
+        """The offset of the first message at or after `second`, or None if there isn't one"""
+        return self.database.next_offset(self.video_id, second)
+
+    def set_messages(self, messages, video_id: str = None, loaded: Event = None):
+        """Switch to a video, importing its messages if the database doesn't have all of them yet"""
+        if video_id and messages and not self.database.is_complete(video_id):
+            self.database.delete_video(video_id)
+            self.database.insert_messages(video_id, list(messages))
+            self.database.set_video(video_id, complete=True)
+        self.video_id = video_id
+        self._count = self.database.count(video_id) if video_id else 0
+        self._activity = None
+
+    def activity(self, term: str = None) -> ActivityIndex:
+        """Message counts over time, counted by the database. With a term, counts only the messages containing it."""
+        if term:
+            return ActivityIndex.from_counts(self.database.activity_counts(self.video_id, term=term))
+        if self._activity is None:
+            self._activity = ActivityIndex.from_counts(self.database.activity_counts(self.video_id))
+        return self._activity
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, item):
+        raise TypeError('SQLiteMessageStore does not support indexing; use get()')
+
+
+class WindowedMessageStore:
+    """A MessageStore that only keeps a sliding window of decoded messages around the playhead.
 
-        return results
+    Messages are located by bisecting their offsets, which for a columnar chat are memory-mapped
+    from disk, so resident memory depends on the window size rather than the length of the chat.
+    The window is refilled when a request gets close to its edge, prefetching in the direction
+    of playback and dropping the messages left behind."""
 
-    def set_messages(self, messages: list):
+    def __init__(self, messages, prefetch: int = PREFETCH_MESSAGES, keep_behind: int = KEEP_BEHIND_MESSAGES):
+        self.prefetch: int = prefetch
+        self.keep_behind: int = keep_behind
+        self.messages = []
+        self._activity: ActivityIndex = None
+        self.set_messages(messages)
+
+    def get(self, start_second: float, end_second: float, earlier_messages: int = 0):
+        if start_second < 0:
+            return None
+        first: int = max(0, bisect_left(self.offsets, start_second) - earlier_messages)
+        last: int = max(first, bisect_left(self.offsets, end_second))
+        forward: bool = start_second >= self._previous_second
+        self._previous_second = start_second
+        self._fill(first, last, forward)
+        return self._window[first - self._window_start:last - self._window_start]
+
+    def next_offset(self, second: float) -> float:
+        """The offset of the first message at or after `second`, or None if there isn't one"""
+        index: int = bisect_left(self.offsets, second)
+        return self.offsets[index] if index < len(self.offsets) else None
+
+    def set_messages(self, messages, video_id: str = None, loaded: Event = None):
+        if isinstance(self.messages, ColumnarChat) and self.messages is not messages:
+            self.offsets = None
+            self.messages.close()
         self.messages = messages
-        self.pointer = 0
+        self.video_id: str = video_id
+        offsets = getattr(messages, 'offsets', None)
+        self.offsets = offsets if offsets is not None else array('d', (message.offset for message in messages))
+        self._window: list = []
+        self._window_start: int = 0
+        self._previous_second: float = 0.0
+        self._activity = None
+
+    def activity(self, term: str = None) -> ActivityIndex:
+        """Message counts over time, built from the offsets on first use.
+        With a term, counts only the messages containing it, which decodes every message once."""
+        if term:
+            duration: float = self.offsets[-1] if len(self.offsets) else 0
+            return ActivityIndex.from_offsets(term_offsets(self.messages, term), duration=duration)
+        if self._activity is None:
+            self._activity = ActivityIndex.from_offsets(self.offsets)
+        return self._activity
+
+    def _fill(self, first: int, last: int, forward: bool):
+        """Make sure messages[first:last] are decoded, with room to spare in the direction of playback"""
+        window_start: int = self._window_start
+        window_end: int = window_start + len(self._window)
+        margin: int = self.prefetch // 2
+        if window_start <= first and last <= window_end:
+            if forward and (window_end - last >= margin or window_end == len(self.offsets)):
+                return
+            if not forward and (first - window_start >= margin or window_start == 0):
+                return
+
+        if forward:
+            start: int = max(0, first - self.keep_behind)
+            end: int = min(len(self.offsets), last + self.prefetch)
+        else:
+            start = max(0, first - self.prefetch)
+            end = min(len(self.offsets), last + self.keep_behind)
+        if end <= window_start or start >= window_end:
+            self._window = self.messages[start:end]
+        else:
+            self._window = (self.messages[start:window_start] if start < window_start else []) + \
+                           self._window[max(start, window_start) - window_start:min(end, window_end) - window_start] + \
+                           (self.messages[window_end:end] if window_end < end else [])
+        self._window_start = start
 
     def __getitem__(self, item):
         return self.messages[item]
@@ -0,0 +1,54 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+
+import chat_downloader
+from chat_downloader import find_raw_cache, get_manifest, is_stale, rederive_chat, set_bttv_emotes, format_seconds
+
+
+def init_worker(cache_folder: str, emotes_folder: str, bttv_emotes: list):
+    """Give a worker process the same configuration as the parent, however it was started"""
+    chat_downloader.CACHE_FOLDER = cache_folder
+    chat_downloader.EMOTES_FOLDER = emotes_folder
+    set_bttv_emotes(bttv_emotes)
+
+
+def rederive_library(video_ids: list, num_workers: int = None, verbose=True) -> dict:
+    """Reprocess the raw comments of many videos in parallel, one process per core.
+    Returns {video_id: new chat filename, or the error}."""
+    results: dict = {}
+    with ProcessPoolExecutor(num_workers, initializer=init_worker,
+                             initargs=(chat_downloader.CACHE_FOLDER, chat_downloader.EMOTES_FOLDER,
+                                       list(chat_downloader.bttv_emotes))) as pool:
+        futures: dict = {pool.submit(rederive_chat, video_id): video_id for video_id in video_ids}
+        for future in as_completed(futures):
+            video_id: str = futures[future]
+            try:
+                results[video_id] = future.result()
+            except Exception as e:
+                results[video_id] = repr(e)
+            if verbose:
+                print(f'{video_id}: {results[video_id]}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocess cached chats from their raw comments, offline.')
+    parser.add_argument('video_ids', nargs='*', help='videos to reprocess (default: every stale cached chat)')
+    parser.add_argument('--all', action='store_true', help='reprocess every chat with raw comments, stale or not')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='processes to use')
+    args = parser.parse_args()
+
+    video_ids: list = args.video_ids or [video_id for video_id in sorted(get_manifest().entries())
+                                         if (args.all or is_stale(video_id)) and find_raw_cache(video_id)]
+    if not video_ids:
+        print('Nothing to reprocess.')
+        return
+    start_time: float = time()
+    rederive_library(video_ids, num_workers=args.jobs)
+    print(f'Reprocessed {len(video_ids)} videos in {format_seconds(time() - start_time)}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import asyncio
+import base64
+import os
+import shutil
+import socket
+import sys
+import tempfile
+from threading import Thread
+
+from aiohttp import web
+
+HOST: str = '127.0.0.1'
+PAGE_SIZE: int = 60  # Comments per page, like the v5 comments endpoint
+MESSAGES_PER_MINUTE: int = 120
+FAIL_EVERY: int = 7  # Every this many-th API request gets a 503, to exercise retries
+# A 1x1 transparent PNG, served for every emote
+EMOTE_IMAGE: bytes = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6'
+                                      'kgAAAABJRU5ErkJggg==')
+
+
+class StandInServer:
+    """A local stand-in for the parts of the Twitch API and emote CDN the downloader uses, serving a synthetic chat
+    per video. Video IDs give the VOD length in minutes by their last two digits, and every FAIL_EVERY-th API
+    request is answered with a 503, so downloads have to retry."""
+
+    def __init__(self, fail_every: int = FAIL_EVERY, page_size: int = PAGE_SIZE):
+        self.fail_every: int = fail_every
+        self.page_size: int = page_size
+        self.requests: int = 0
+        self.failures: int = 0
+        self.offset_requests: int = 0  # Comment pages requested by offset rather than by cursor
+        self.missing_pages: dict = {}  # {video_id: cursor pages served before one is answered with a 404, once}
+        self.port: int = None
+        self.url: str = None
+        self._loop: asyncio.AbstractEventLoop = None
+        self._runner: web.AppRunner = None
+        self._chats: dict = {}
+
+    def start(self) -> str:
+        """Serve on a free port on a background thread and return the base URL"""
+        self._loop = asyncio.new_event_loop()
+        Thread(target=self._loop.run_forever, name='StandInServer', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self.url
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def chat(self, video_id: str) -> list:
+        """The synthetic raw comments of a video"""
+        if video_id not in self._chats:
+            duration: int = video_duration(video_id)
+            num_comments: int = duration * MESSAGES_PER_MINUTE // 60
+            self._chats[video_id] = [{
+                '_id': f'{video_id}-{index}',
+                'content_offset_seconds': round(index * duration / num_comments, 3),
+                'commenter': {'display_name': f'viewer{index % 97}'},
+                'message': {'user_color': None, 'fragments': [{'text': f'message {index} @viewer{index % 13}'}] + (
+                    [{'text': 'Kappa', 'emoticon': {'emoticon_id': '25', 'emoticon_set_id': ''}}]
+                    if index % 5 == 0 else [])}
+            } for index in range(num_comments)]
+        return self._chats[video_id]
+
+    async def _start(self):
+        app: web.Application = web.Application(middlewares=[self._api_middleware])
+        app.router.add_get('/helix/videos', self._info)
+        app.router.add_route('*', '/v5/videos/{video_id}', self._video)
+        app.router.add_get('/v5/videos/{video_id}/comments', self._comments)
+        app.router.add_get('/emoticons/v1/{emote_id}/{emote_size}', self._emote)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        server_socket: socket.socket = socket.socket()
+        server_socket.bind((HOST, 0))
+        await web.SockSite(self._runner, server_socket).start()
+        self.port = server_socket.getsockname()[1]
+        self.url = f'http://{HOST}:{self.port}'
+
+    @web.middleware
+    async def _api_middleware(self, request: web.Request, handler):
+        """Require a client ID on the API, like Twitch, and fail every fail_every-th API request"""
+        if request.path.startswith('/emoticons/'):
+            return await handler(request)
+        if 'Client-ID' not in request.headers:
+            return web.json_response({'error': 'Unauthorized'}, status=401)
+        self.requests += 1
+        if self.fail_every and self.requests % self.fail_every == 0:
+            self.failures += 1
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return await handler(request)
+
+    async def _info(self, request: web.Request) -> web.Response:
+        video_id: str = request.query.get('id')
+        minutes: int = video_duration(video_id) // 60
+        return web.json_response({'data': [{
+            'id': video_id,
+            'title': f'Stand-in VOD {video_id}',
+            'duration': f'{minutes // 60}h{minutes % 60}m0s'
+        }]})
+
+    async def _video(self, request: web.Request) -> web.Response:
+        return web.json_response({'_id': f'v{request.match_info["video_id"]}'})
+
+    async def _comments(self, request: web.Request) -> web.Response:
+        video_id: str = request.match_info['video_id']
+        comments: list = self.chat(video_id)
+        if 'cursor' in request.query and request.query.get('cursor'):
+            if video_id in self.missing_pages:
+                self.missing_pages[video_id] -= 1
+                if self.missing_pages.get(video_id) < 0:
+                    del self.missing_pages[video_id]
+                    return web.json_response({'error': 'Not Found', 'status': 404}, status=404)
+            first: int = int(base64.b64decode(request.query.get('cursor')))
+        else:
+            self.offset_requests += 1
+            offset: float = float(request.query.get('content_offset_seconds', 0))
+            first = next((index for index, comment in enumerate(comments)
+                          if comment.get('content_offset_seconds') >= offset), len(comments))
+        page: dict = {'comments': comments[first:first + self.page_size]}
+        if first + self.page_size < len(comments):
+            page['_next'] = base64.b64encode(str(first + self.page_size).encode()).decode()
+        return web.json_response(page)
+
+    async def _emote(self, _: web.Request) -> web.Response:
+        return web.Response(body=EMOTE_IMAGE, content_type='image/png')
+
+
+def video_duration(video_id: str) -> int:
+    """Seconds in a stand-in VOD: as many minutes as the last two digits of its ID, and at least one"""
+    return max(1, int(video_id[-2:])) * 60
+
+
+def check_downloads(server: StandInServer) -> list:
+    """Download from the stand-in server the way the batch downloader does, killing and resuming one video.
+    Returns what went wrong."""
+    import chat_downloader
+    from batch_downloader import BatchDownloader, read_video_ids
+    from chat_downloader import AsyncChatDownloader, find_chat_cache, get_manifest, iter_chat
+    from http_client import AsyncHttpClient
+
+    problems: list = []
+
+    def check_chat(video_id: str):
+        chat_filename: str = find_chat_cache(video_id)
+        if chat_filename is None:
+            problems.append(f'{video_id}: no chat cached')
+            return
+        ids: list = [message.id for message in iter_chat(chat_filename)]
+        expected_ids: list = [comment.get('_id') for comment in server.chat(video_id)]
+        if ids != expected_ids:
+            problems.append(f'{video_id}: cached {len(ids)} messages ({len(set(ids))} unique), '
+                            f'expected {len(expected_ids)} in order')
+
+    # A batch with several segments per video and an entry that isn't a video
+    video_ids, skipped = read_video_ids(['https://www.twitch.tv/videos/1000030', 'not a video', 'v2000045'], [])
+    summary: dict = BatchDownloader(video_ids, segments=4, verbose=False, skipped=skipped).run()
+    if summary.get('statuses') != {'skipped': 1, 'downloaded': 2}:
+        problems.append(f'batch statuses {summary.get("statuses")}, expected 1 skipped and 2 downloaded')
+    for video_id in video_ids:
+        check_chat(video_id)
+    if not server.failures:
+        problems.append('no request failed, so retries were not exercised')
+
+    # A download killed halfway resumes from its checkpoint instead of starting over
+    async def download_killed_and_resumed(video_id: str):
+        async with AsyncHttpClient(chat_downloader.get_headers()) as client:
+            first_run: AsyncChatDownloader = AsyncChatDownloader(client, video_id, num_workers=2)
+            task: asyncio.Task = asyncio.ensure_future(first_run.download_chat())
+            expected: int = len(server.chat(video_id))
+            while first_run.num_messages < expected // 2 and not task.done():
+                await asyncio.sleep(0.01)
+            first_run.kill()
+            if await task:
+                problems.append(f'{video_id}: finished before it could be killed')
+            offset_requests: int = server.offset_requests
+            await AsyncChatDownloader(client, video_id, num_workers=2).download_chat()
+            if server.offset_requests != offset_requests:
+                problems.append(f'{video_id}: resumed download started segments over')
+
+    asyncio.run(download_killed_and_resumed('3000059'))
+    check_chat('3000059')
+
+    # A page that can't be fetched fails the download and keeps its checkpoint, rather than caching part of the chat
+    server.missing_pages['4000010'] = 2
+    summary = BatchDownloader(['4000010'], segments=1, verbose=False).run()
+    if summary.get('statuses') != {'failed': 1}:
+        problems.append(f'4000010: {summary.get("statuses")} with a missing page, expected it to fail')
+    if find_chat_cache('4000010') or get_manifest().get('4000010'):
+        problems.append('4000010: part of the chat was cached after a page was missing')
+    summary = BatchDownloader(['4000010'], segments=1, verbose=False).run()
+    if summary.get('statuses') != {'downloaded': 1}:
+        problems.append(f'4000010: {summary.get("statuses")} when retried, expected it to download')
+    check_chat('4000010')
+    return problems
+
+
+def main():
+    server: StandInServer = StandInServer()
+    url: str = server.start()
+    cache_folder: str = tempfile.mkdtemp()
+    # The downloader reads its base URLs when it is imported
+    os.environ['TWITCH_API_URL'] = url
+    os.environ['TWITCH_EMOTE_CDN_URL'] = url
+    import chat_downloader
+    chat_downloader.CACHE_FOLDER = cache_folder
+    chat_downloader.EMOTES_FOLDER = os.path.join(cache_folder, 'emote_cache')
+    os.makedirs(chat_downloader.EMOTES_FOLDER)
+    chat_downloader.headers = {'Client-ID': 'stand-in'}
+    try:
+        problems: list = check_downloads(server)
+    finally:
+        server.stop()
+        shutil.rmtree(cache_folder, ignore_errors=True)
+    print(f'{server.requests} API requests, {server.failures} answered with 503.')
+    if problems:
+        sys.exit('FAILED\n' + '\n'.join(problems))
+    print('Downloads from the stand-in server are complete and in order.')
+
+
+if __name__ == '__main__':
+    main()